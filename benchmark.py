@@ -0,0 +1,646 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the stock bot
+
+Usage:
+    python benchmark.py records [--items N] [--repeat N] [--output results.json]
+    python benchmark.py markdown [--changes N] [--repeat N] [--output results.json]
+    python benchmark.py changelog [--keys N] [--events N] [--repeat N] [--output results.json]
+    python benchmark.py pipeline [--zips N] [--stores N] [--parts N] [--sweeps N]
+                                 [--latency MS] [--error-rate F] [--payload FILE]
+                                 [--dynamodb-endpoint URL] [--output results.json]
+
+The pipeline benchmark runs the full handler against a local stand-in for
+Apple's fulfillment API and Telegram, and against dynamodb-local
+(`docker compose up -d dynamodb` exposes it on http://localhost:8021).
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Imported by load_lambda_function(), since it reads its configuration at import time
+lambda_function = None
+
+SAMPLE_TITLES = [
+    'iPhone 17 Pro Max 256GB Deep Blue',
+    'iPhone 17 Pro Max 1TB Cosmic Orange',
+    'iPhone 17 Pro 512GB Silver',
+    'iPhone 17 Pro 256GB Deep Blue',
+]
+
+
+def load_lambda_function(env):
+    """
+    Apply `env` and import lambda_function
+
+    Values always override the caller's environment, so exported production
+    settings can't point a benchmark at Apple, real chats or the real table.
+    """
+    global lambda_function
+    for name, value in env.items():
+        os.environ[name] = value
+    import lambda_function as module
+    lambda_function = module
+    return module
+
+
+def synthetic_parts(count):
+    """Raw per-part values as they come out of a fulfillment response"""
+    parts = []
+    for i in range(count):
+        model = SAMPLE_TITLES[i % len(SAMPLE_TITLES)]
+        model_parts = model.split(' ')
+        parts.append({
+            'model': model,
+            'store': f"Store {i // len(SAMPLE_TITLES)}",
+            'zipCode': f"{10000 + i % 97}",
+            'city': 'Springfield',
+            'distance': round((i * 7919 % 5000) / 100, 1),
+            'distance_label': f"{round((i * 7919 % 5000) / 100, 1)} mi",
+            'screen_size': '6.9' if 'Pro Max' in model else '6.3',
+            'color': '-'.join(model_parts[5:]).lower(),
+            'storage': model_parts[4].lower(),
+            'availability': 'available' if i % 3 else 'unavailable',
+        })
+    return parts
+
+
+def dict_path(parts):
+    """The pre-Availability pipeline: dict per part, eager Markdown, float() on every sort key"""
+    escape = lambda_function.escape_markdown
+    currently_available = []
+    changes = []
+    for p in parts:
+        maps_link = f"{lambda_function.GOOGLE_MAPS_BASE_URL}1.0,2.0"
+        buy_url = f"{lambda_function.APPLE_BUY_BASE_URL}6.9-inch-display-{p['storage']}-{p['color']}-unlocked"
+        icon = '🚫'
+        if p['availability'] == 'available':
+            icon = '✅'
+            currently_available.append({
+                'model': p['model'],
+                'store': p['store'],
+                'zipCode': p['zipCode'],
+                'city': p['city'],
+                'distance': p['distance'],
+                'screen_size': float(p['screen_size']),
+                'color': p['color'],
+                'storage': p['storage'],
+                'maps_link': maps_link,
+                'buy_url': buy_url
+            })
+        changes.append(f"📱 **{escape(p['model'])}**\n🏪 {escape(p['store'])} - {escape(p['city'])} *({escape(p['zipCode'])})*\n📍 [{escape(p['distance_label'])}]({maps_link})\n\n{icon} **{p['availability'].upper()}**\n\n🛒 [Buy Now]({buy_url})")
+
+    unique, seen = [], set()
+    for item in currently_available:
+        key = f"{item['model']}@{item['store']}@{item['city']}@{item['zipCode']}"
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+
+    ordered = sorted(unique, key=lambda item: (float(item['distance']), float(item['screen_size']), item['color']))
+    return ordered, changes
+
+
+def record_path(parts):
+    """The Availability pipeline: slotted records, precomputed sort key, Markdown deferred"""
+    currently_available = []
+    changes = []
+    for p in parts:
+        record = lambda_function.Availability(
+            key=f"{p['model']}@{p['store']}",
+            availability=p['availability'],
+            model=p['model'],
+            store=p['store'],
+            zip_code=p['zipCode'],
+            city=p['city'],
+            distance=float(p['distance']),
+            distance_label=p['distance_label'],
+            screen_size=6.9 if p['screen_size'] == '6.9' else 6.3,
+            color=p['color'],
+            storage=p['storage'],
+            maps_link=f"{lambda_function.GOOGLE_MAPS_BASE_URL}1.0,2.0",
+            buy_url=f"{lambda_function.APPLE_BUY_BASE_URL}6.9-inch-display-{p['storage']}-{p['color']}-unlocked",
+        )
+        if record.is_available:
+            currently_available.append(record)
+        changes.append(record)
+
+    unique, seen = [], set()
+    for item in currently_available:
+        key = (item.model, item.store, item.city, item.zip_code)
+        if key not in seen:
+            seen.add(key)
+            unique.append(item)
+
+    return lambda_function.sort_available_items(unique), changes
+
+
+def measure(func, *args, repeat=5):
+    """Best wall time over `repeat` runs plus peak traced memory of one run"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return {'best_seconds': min(timings), 'peak_bytes': peak}
+
+
+def bench_records(args):
+    load_lambda_function({
+        'APPLE_BUY_BASE_URL': 'https://www.apple.com/shop/buy-iphone/iphone-17-pro/',
+        'GOOGLE_MAPS_BASE_URL': 'https://maps.google.com/?q=',
+    })
+    parts = synthetic_parts(args.items)
+    results = {
+        'dict': measure(dict_path, parts, repeat=args.repeat),
+        'availability': measure(record_path, parts, repeat=args.repeat),
+    }
+    for name, result in results.items():
+        print(f"{name:>14}: {result['best_seconds'] * 1000:9.1f} ms  peak {result['peak_bytes'] / 1024:9.0f} KiB")
+    return {'benchmark': 'records', 'items': args.items, 'results': results}
+
+
+def legacy_escape_markdown(text):
+    """escape_markdown() before the translation table: one str.replace() pass per character"""
+    if not text:
+        return text
+    text = str(text)
+    for char in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '=', '|', '{', '}', '!']:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+
+def legacy_render(change_groups, available_items):
+    """The consolidated alert before block rendering: per-field replace() escaping and += for the table"""
+    escape = legacy_escape_markdown
+    blocks = []
+    for zip_code, area_city, changes in change_groups:
+        blocks.append(f"**🚨 STOCK ALERT - {area_city} ({zip_code}) 🚨**")
+        for item in changes:
+            icon = '✅' if item.is_available else '🚫'
+            blocks.append(f"📱 **{escape(item.model)}**\n🏪 {escape(item.store)} - {escape(item.city)} *({escape(item.zip_code)})*\n📍 [{escape(item.distance_label)}]({item.maps_link})\n\n{icon} **{item.availability.upper()}**\n\n🛒 [Buy Now]({item.buy_url})")
+    message = "\n\n---\n\n".join(blocks)
+
+    sorted_items = lambda_function.sort_available_items(available_items)
+    table_text = "\n**📋 CURRENTLY AVAILABLE**\n\n"
+    for item in sorted_items[:50]:
+        table_text += f"✅ **{escape(item.model)}** @ {escape(item.store)} - {escape(item.city)} *({escape(item.zip_code)})* - *{escape(item.distance)} mi* - [Buy Now]({item.buy_url})\n"
+    if len(sorted_items) > 50:
+        table_text += f"\n*\\+{len(sorted_items) - 50} more locations available\\.\\.\\.*"
+    return message + "\n\n---\n" + table_text
+
+
+def legacy_chunk(message, limit=4000):
+    """telegram_bot_sendtext()'s old line-based splitter, which truncates any line longer than `limit`"""
+    if len(message) <= limit:
+        return [message]
+    chunks = []
+    current_chunk = ""
+    for line in message.split('\n'):
+        if len(current_chunk) + len(line) + 1 > limit:
+            if current_chunk:
+                chunks.append(current_chunk)
+                current_chunk = line
+            else:
+                chunks.append(line[:limit])
+        else:
+            current_chunk = current_chunk + '\n' + line if current_chunk else line
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+
+def legacy_markdown_path(change_groups, available_items):
+    return legacy_chunk(legacy_render(change_groups, available_items))
+
+
+def block_markdown_path(change_groups, available_items):
+    blocks = lambda_function.change_blocks(change_groups) + lambda_function.availability_table_blocks(available_items)
+    return lambda_function.chunk_blocks(blocks, lambda_function.TELEGRAM_MESSAGE_LIMIT - lambda_function.CHUNK_HEADER_RESERVE)
+
+
+def split_entries(chunks):
+    """Count change entries whose lines ended up in two different chunks"""
+    return sum(1 for chunk in chunks[1:] if not chunk.startswith(('📱', '**🚨', '\n**📋', '✅', '\n*')))
+
+
+def bench_markdown(args):
+    load_lambda_function({
+        'APPLE_BUY_BASE_URL': 'https://www.apple.com/shop/buy-iphone/iphone-17-pro/',
+        'GOOGLE_MAPS_BASE_URL': 'https://maps.google.com/?q=',
+    })
+    available, changes = record_path(synthetic_parts(args.changes))
+    zip_codes = sorted({item.zip_code for item in changes})
+    change_groups = [(zip_code, 'Springfield', [item for item in changes if item.zip_code == zip_code]) for zip_code in zip_codes]
+    fields = [field for item in changes for field in (item.model, item.store, item.city, item.zip_code, item.distance_label)]
+
+    results = {
+        'escape_legacy': measure(lambda: [legacy_escape_markdown(field) for field in fields], repeat=args.repeat),
+        'escape_translate': measure(lambda: [lambda_function.escape_markdown(field) for field in fields], repeat=args.repeat),
+        'alert_legacy': measure(legacy_markdown_path, change_groups, available, repeat=args.repeat),
+        'alert_blocks': measure(block_markdown_path, change_groups, available, repeat=args.repeat),
+    }
+    for name, result in results.items():
+        print(f"{name:>16}: {result['best_seconds'] * 1000:9.2f} ms  peak {result['peak_bytes'] / 1024:9.0f} KiB")
+
+    for name, path in (('alert_legacy', legacy_markdown_path), ('alert_blocks', block_markdown_path)):
+        chunks = path(change_groups, available)
+        results[name]['chunks'] = len(chunks)
+        results[name]['split_entries'] = split_entries(chunks)
+        print(f"{name:>16}: {len(chunks)} messages, {results[name]['split_entries']} entries split across messages")
+
+    return {'benchmark': 'markdown', 'changes': args.changes, 'fields': len(fields), 'results': results}
+
+
+def check(condition, message):
+    """Abort the benchmark if a correctness check fails"""
+    if not condition:
+        raise SystemExit(f"Check failed: {message}")
+
+
+def synthetic_view(keys, now):
+    """A change log view of `keys` model@store keys"""
+    values = ['available', 'unavailable', 'ineligible', None]
+    view = {}
+    for i in range(keys):
+        availability = values[i % len(values)]
+        view[f"{SAMPLE_TITLES[i % len(SAMPLE_TITLES)]}@Store {i}"] = (availability, now - i, now - i if availability == 'available' else None)
+    return view
+
+
+def bench_changelog(args):
+    """
+    Snapshot packing and event replay through FileChangeLog, checking that
+    snapshots round-trip, a cold reader rebuilds the writer's view, and a
+    reserved but unwritten sequence number is skipped only after its timeout
+    """
+    load_lambda_function({'CHANGE_LOG_BACKEND': ''})
+    now = int(time.time())
+    view = synthetic_view(args.keys, now)
+
+    blob = lambda_function.pack_snapshot(42, view)
+    check(lambda_function.unpack_snapshot(blob) == (42, view), 'snapshot round trip')
+    results = {
+        'pack': measure(lambda_function.pack_snapshot, 42, view, repeat=args.repeat),
+        'unpack': measure(lambda_function.unpack_snapshot, blob, repeat=args.repeat),
+    }
+    results['pack']['bytes'] = len(blob)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Snapshot partway through, so a cold reader loads it and replays the tail after it
+        writer = lambda_function.FileChangeLog(directory, max(1, args.events * 2 // 3))
+        keys = list(view)
+        batch = []
+        for i in range(args.events):
+            key = keys[i % len(keys)]
+            batch.append((key, view[key][0], 'available' if i % 2 else 'unavailable'))
+            if len(batch) == 100 or i == args.events - 1:
+                writer.append(batch)
+                batch = []
+        check(writer.seq == args.events, f"writer at seq {writer.seq}, expected {args.events}")
+
+        def cold_sync():
+            reader = lambda_function.FileChangeLog(directory, args.events)
+            cache = lambda_function.AvailabilityCache(len(view) * 2, 300)
+            reader.sync(cache)
+            return reader, cache
+
+        results['cold_sync'] = measure(cold_sync, repeat=args.repeat)
+        reader, cache = cold_sync()
+        results['cold_sync']['replayed'] = reader.seq - reader.snapshot_seq
+        check(reader.seq == writer.seq and reader.view == writer.view, 'cold reader matches the writer')
+        check(len(cache.entries) == len(writer.view), 'cold sync warms every key')
+
+        # Leave seq head+1 reserved but unwritten, as if its writer had failed
+        head = writer.seq
+        writer._write_events([lambda_function.ChangeEvent(head + 2, now, keys[0], None, 'available')])
+        cache = lambda_function.AvailabilityCache(len(view) * 2, 300)
+        replayed = reader.sync(cache)
+        check(replayed == 1 and reader.seq == head, 'sync stops at a fresh gap')
+        check(list(cache.entries) == [keys[0]], 'warm sync refreshes only replayed keys')
+        lambda_function.CHANGE_LOG_GAP_TIMEOUT = 0
+        reader.sync()
+        check(reader.seq == head + 2 and reader.view[keys[0]][0] == 'available', 'sync skips a timed-out gap')
+
+    for name, result in results.items():
+        print(f"{name:>10}: {result['best_seconds'] * 1000:9.2f} ms  peak {result['peak_bytes'] / 1024:9.0f} KiB")
+    print(f"{'snapshot':>10}: {len(blob)} bytes for {len(view)} keys; all checks passed")
+    return {'benchmark': 'changelog', 'keys': args.keys, 'events': args.events, 'results': results}
+
+
+class StubState:
+    """Counters and knobs shared between the stub server threads and the benchmark"""
+
+    def __init__(self, args):
+        self.stores = args.stores
+        self.store_step = max(1, args.stores // 2)
+        self.latency = args.latency / 1000
+        self.error_rate = args.error_rate
+        self.change_rate = args.change_rate
+        self.payload = None
+        if args.payload:
+            with open(args.payload, 'rb') as f:
+                self.payload = f.read()
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.rng = random.Random(args.seed)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def take_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def is_available(self, store, part):
+        """Stable baseline per store/part, flipped for `change_rate` of them each epoch"""
+        baseline = random.Random(f"{store}|{part}").random() < 2 / 3
+        flipped = random.Random(f"{store}|{part}|{self.epoch}").random() < self.change_rate
+        return baseline != flipped
+
+    def fulfillment_payload(self, location, parts):
+        if self.payload is not None:
+            return self.payload
+
+        # Neighbouring ZIP codes overlap by half their stores, like Apple's do
+        first_store = (int(location) % 10000) * self.store_step
+        stores = []
+        for store_number in range(first_store, first_store + self.stores):
+            parts_availability = {}
+            for i, part in enumerate(parts):
+                title = SAMPLE_TITLES[i % len(SAMPLE_TITLES)]
+                parts_availability[part] = {
+                    'pickupDisplay': 'available' if self.is_available(store_number, part) else 'unavailable',
+                    'messageTypes': {
+                        'regular': {'storePickupProductTitle': title, 'storePickupQuote': f"Today at Store {store_number}"},
+                        'compact': {'storePickupProductTitle': title, 'storePickupQuote': 'Today'},
+                    },
+                    'storePickEligible': True,
+                }
+            stores.append({
+                'storeName': f"Store {store_number}",
+                'storeNumber': f"R{store_number:03d}",
+                'storelatitude': 40.0 + store_number / 1000,
+                'storelongitude': -74.0 - store_number / 1000,
+                'storedistance': round(1 + (store_number - first_store) * 2.5, 1),
+                'storeDistanceWithUnit': f"{round(1 + (store_number - first_store) * 2.5, 1)} mi",
+                'city': 'Springfield',
+                'address': {'address': f"{store_number} Main Street", 'address2': '', 'postalCode': location},
+                'storeHours': {'hours': [{'storeTimings': '10:00 a.m. - 9:00 p.m.', 'storeDays': 'Mon - Sat:'}] * 7},
+                'partsAvailability': parts_availability,
+            })
+        payload = {'head': {'status': '200'}, 'body': {'content': {'pickupMessage': {'stores': stores, 'location': location}}}}
+        return json.dumps(payload).encode()
+
+
+def make_stub_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if not url.path.startswith('/fulfillment-messages'):
+                self.send_body(404, b'{}')
+                return
+
+            state.count('apple_requests')
+            if state.latency:
+                time.sleep(state.latency)
+            with state.lock:
+                failed = state.rng.random() < state.error_rate
+                status = state.rng.choice([503, 541])
+            if failed:
+                state.count(f'apple_{status}')
+                self.send_body(status, b'{}')
+                return
+
+            query = parse_qs(url.query)
+            parts = [query[f'parts.{i}'][0] for i in range(len(query)) if f'parts.{i}' in query]
+            self.send_body(200, state.fulfillment_payload(query['location'][0], parts))
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            state.count('telegram_requests')
+            self.send_body(200, b'{"ok": true, "result": {}}')
+
+    return StubHandler
+
+
+def count_dynamodb_calls(module, counts):
+    """Count DynamoDB API calls per operation through botocore's event hooks"""
+    lock = threading.Lock()
+
+    def before_call(model, **kwargs):
+        with lock:
+            counts[model.name] = counts.get(model.name, 0) + 1
+
+    client = module.get_dynamodb().meta.client
+    client.meta.events.register('before-call.dynamodb', before_call)
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args):
+    state = StubState(args)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    zip_codes = [f"{10001 + i:05d}" for i in range(args.zips)]
+    models = [f"BENCH{i}LL/A" for i in range(args.parts)]
+    table_name = f"IPHONE_STOCK_BENCH_{os.getpid()}"
+
+    module = load_lambda_function({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'test',
+        'AWS_SECRET_ACCESS_KEY': 'test',
+        'DYNAMODB_ENDPOINT_URL': args.dynamodb_endpoint,
+        'DYNAMODB_TABLE_NAME': table_name,
+        'APPLE_FULFILLMENT_BASE_URL': f"{base_url}/fulfillment-messages",
+        'APPLE_BUY_BASE_URL': 'https://www.apple.com/shop/buy-iphone/iphone-17-pro/',
+        'GOOGLE_MAPS_BASE_URL': 'https://maps.google.com/?q=',
+        'APPLE_COOKIES': 'dssid2=benchmark; as_sfa=benchmark',
+        'APPLE_COOKIE_JAR_FILE': '',
+        'TELEGRAM_API_BASE_URL': f"{base_url}/bot",
+        'TELEGRAM_BOT_TOKEN': 'benchmark',
+        'TELEGRAM_CHAT_IDS': ','.join(str(1000 + i) for i in range(args.recipients)),
+        'ZIP_CODES': ','.join(zip_codes),
+        'IPHONE_MODELS': ','.join(models),
+        'INITIAL_RETRY_DELAY': str(args.retry_delay),
+        # Keep every optional feature that reaches outside the stub switched off
+        'SUBSCRIPTIONS_FILE': '',
+        'SUBSCRIPTIONS_JSON': '',
+        'SHARD_COUNT': '1',
+        'SHARD_FUNCTION_NAME': '',
+        'CHANGE_LOG_BACKEND': '',
+        'ALERT_COALESCE_WINDOW': '0',
+        'PART_METADATA_FILE': '',
+    })
+
+    from local_runner import create_table_if_not_exists
+    created_table = create_table_if_not_exists()
+
+    dynamodb_counts = {}
+    count_dynamodb_calls(module, dynamodb_counts)
+
+    sweeps = []
+    try:
+        for sweep in range(args.sweeps + 1):
+            state.epoch = sweep
+            state.take_counts()
+            dynamodb_counts.clear()
+
+            # The last sweep is traced for peak memory; tracing skews its latency
+            traced = sweep == args.sweeps
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    module.handler({}, {})
+                finally:
+                    sys.stdout = stdout
+            elapsed = time.perf_counter() - start
+
+            if traced:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                peak_bytes = peak
+                continue
+
+            counters = module.metrics.counters
+            sweeps.append({
+                'seconds': elapsed,
+                'requests': state.take_counts(),
+                'dynamodb_calls': dict(dynamodb_counts),
+                'responses_unchanged': counters.get('AppleResponsesUnchanged', 0) + counters.get('AppleResponsesNotModified', 0),
+                'responses_changed': counters.get('AppleResponsesChanged', 0),
+            })
+            print(f"sweep {sweep + 1:>3}: {elapsed * 1000:8.1f} ms  {sweeps[-1]['requests']}  dynamodb {sweeps[-1]['dynamodb_calls']}")
+    finally:
+        # Never drop a table this run didn't create
+        if created_table:
+            module.get_table().delete()
+        server.shutdown()
+
+    latencies = sorted(s['seconds'] for s in sweeps)
+    summary = {
+        'sweep_seconds_mean': sum(latencies) / len(latencies),
+        'sweep_seconds_p50': latencies[len(latencies) // 2],
+        'sweep_seconds_max': latencies[-1],
+        'apple_requests_per_sweep': sum(s['requests'].get('apple_requests', 0) for s in sweeps) / len(sweeps),
+        'telegram_requests_per_sweep': sum(s['requests'].get('telegram_requests', 0) for s in sweeps) / len(sweeps),
+        'dynamodb_calls_per_sweep': sum(sum(s['dynamodb_calls'].values()) for s in sweeps) / len(sweeps),
+        'unchanged_response_rate': (sum(s['responses_unchanged'] for s in sweeps)
+                                    / max(1, sum(s['responses_unchanged'] + s['responses_changed'] for s in sweeps))),
+        'peak_traced_bytes': peak_bytes,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    for name, value in summary.items():
+        print(f"{name:>28}: {value:,.3f}" if isinstance(value, float) else f"{name:>28}: {value:,}")
+
+    return {
+        'benchmark': 'pipeline',
+        'revision': git_revision(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'parameters': {name: value for name, value in vars(args).items() if name not in ('func', 'output')},
+        'summary': summary,
+        'sweeps': sweeps,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    records = subparsers.add_parser('records', help='dict rows vs Availability records')
+    records.add_argument('--items', type=int, default=20000)
+    records.add_argument('--repeat', type=int, default=5)
+    records.set_defaults(func=bench_records)
+
+    markdown = subparsers.add_parser('markdown', help='legacy vs block-based Markdown rendering and chunking')
+    markdown.add_argument('--changes', type=int, default=500, help='Availability changes in the alert')
+    markdown.add_argument('--repeat', type=int, default=20)
+    markdown.set_defaults(func=bench_markdown)
+
+    changelog = subparsers.add_parser('changelog', help='change log snapshot packing and replay, with correctness checks')
+    changelog.add_argument('--keys', type=positive_int, default=5000, help='model@store keys in the view')
+    changelog.add_argument('--events', type=positive_int, default=2000, help='Events appended before the cold sync')
+    changelog.add_argument('--repeat', type=int, default=5)
+    changelog.set_defaults(func=bench_changelog)
+
+    pipeline = subparsers.add_parser('pipeline', help='full handler against local Apple/Telegram stubs and dynamodb-local')
+    pipeline.add_argument('--zips', type=int, default=10, help='ZIP codes per sweep')
+    pipeline.add_argument('--stores', type=int, default=8, help='Stores per ZIP code response')
+    pipeline.add_argument('--parts', type=int, default=9, help='Parts (models) per request')
+    pipeline.add_argument('--sweeps', type=positive_int, default=5)
+    pipeline.add_argument('--recipients', type=int, default=3, help='Telegram chat IDs')
+    pipeline.add_argument('--latency', type=float, default=50, help='Stub fulfillment latency in ms')
+    pipeline.add_argument('--error-rate', type=float, default=0.0, help='Fraction of fulfillment requests answered with 503/541')
+    pipeline.add_argument('--change-rate', type=float, default=0.05, help='Fraction of store/part availability flipped each sweep')
+    pipeline.add_argument('--retry-delay', type=int, default=1, help='INITIAL_RETRY_DELAY for the handler')
+    pipeline.add_argument('--payload', help='Serve this recorded fulfillment JSON instead of synthetic payloads')
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--dynamodb-endpoint', default='http://localhost:8021')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--output', help='Write results as JSON to this file')
+
+    args = parser.parse_args(argv)
+    report = args.func(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
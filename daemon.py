@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Resident scheduler: runs the Lambda handler in a loop inside one process
+
+Sessions, the cookie jar, the availability cache and the DynamoDB client all
+live at module level in lambda_function, so keeping the process up means each
+cycle reuses them instead of paying for container start, pip install, imports
+and table checks every time.
+"""
+
+import argparse
+import os
+import random
+import signal
+import threading
+import time
+
+# Point lambda_function at the local DynamoDB container before it is imported
+os.environ.setdefault('DYNAMODB_ENDPOINT_URL', 'http://dynamodb:8000')
+
+import lambda_function
+from local_runner import create_table_if_not_exists
+
+POLL_INTERVAL = int(os.getenv('POLL_INTERVAL')) if os.getenv('POLL_INTERVAL') else None
+POLL_JITTER = int(os.getenv('POLL_JITTER')) if os.getenv('POLL_JITTER') else None
+COOKIES_FILE = '.cookies'
+
+
+def cookies_mtime():
+    try:
+        return os.stat(COOKIES_FILE).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def run_forever(interval, jitter, stop_event):
+    create_table_if_not_exists()
+
+    last_cookies_mtime = cookies_mtime()
+    cycles = 0
+    total_seconds = 0.0
+
+    while not stop_event.is_set():
+        mtime = cookies_mtime()
+        if mtime != last_cookies_mtime:
+            print(f"=== {COOKIES_FILE} changed, reloading Apple sessions ===")
+            lambda_function.get_apple_session_pool()
+            last_cookies_mtime = mtime
+
+        start = time.perf_counter()
+        try:
+            lambda_function.handler({}, {})
+        except Exception as e:
+            print(f"❌ Cycle failed: {e!r}")
+        elapsed = time.perf_counter() - start
+
+        cycles += 1
+        total_seconds += elapsed
+        print(f"=== Cycle {cycles} took {elapsed:.2f}s (average {total_seconds / cycles:.2f}s) ===")
+
+        delay = max(0, interval + random.uniform(-jitter, jitter))
+        print(f"=== Next cycle in {delay:.0f} seconds ===")
+
+        # Returns early on SIGTERM/SIGINT
+        stop_event.wait(delay)
+
+    print("=== iPhone Stock Bot daemon stopped ===")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interval', type=int, default=POLL_INTERVAL or 300, help="Seconds between cycles (default: POLL_INTERVAL or 300)")
+    parser.add_argument('--jitter', type=int, default=POLL_JITTER if POLL_JITTER is not None else 15,
+                        help="Random +/- seconds added to each interval (default: POLL_JITTER or 15)")
+    args = parser.parse_args()
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print(f"\n=== Received {signal.Signals(signum).name}, stopping after the current cycle ===")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"=== iPhone Stock Bot daemon - every {args.interval}s (±{args.jitter}s) ===")
+    run_forever(args.interval, args.jitter, stop_event)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,37 @@
 #!/usr/bin/python3
 
-import boto3
-import requests
 import time
 import os
 import json
-from urllib.parse import quote
+import threading
+import queue
+import hashlib
+import random
+import re
+import struct
+import sys
+import tempfile
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields, replace
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlparse
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from operator import attrgetter
+
+try:
+    import ijson
+except ImportError:  # Fall back to response.json() when ijson isn't installed
+    ijson = None
 
 # Constants - can be moved to environment variables
 DYNAMODB_TABLE_NAME = os.getenv('DYNAMODB_TABLE_NAME')
+DYNAMODB_ENDPOINT_URL = os.getenv('DYNAMODB_ENDPOINT_URL')
 TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
 APPLE_BUY_BASE_URL = os.getenv('APPLE_BUY_BASE_URL')
 GOOGLE_MAPS_BASE_URL = os.getenv('GOOGLE_MAPS_BASE_URL')
@@ -18,13 +39,117 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTM
 REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT')) if os.getenv('REQUEST_TIMEOUT') else None
 MAX_RETRIES = int(os.getenv('MAX_RETRIES')) if os.getenv('MAX_RETRIES') else None
 INITIAL_RETRY_DELAY = int(os.getenv('INITIAL_RETRY_DELAY')) if os.getenv('INITIAL_RETRY_DELAY') else None
+RETRY_MAX_DELAY = int(os.getenv('RETRY_MAX_DELAY')) if os.getenv('RETRY_MAX_DELAY') else None
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD')) if os.getenv('CIRCUIT_BREAKER_THRESHOLD') else None
+CIRCUIT_BREAKER_COOLDOWN = int(os.getenv('CIRCUIT_BREAKER_COOLDOWN')) if os.getenv('CIRCUIT_BREAKER_COOLDOWN') else None
 IPHONE_MODELS = os.getenv('IPHONE_MODELS')
 APPLE_FULFILLMENT_BASE_URL = os.getenv('APPLE_FULFILLMENT_BASE_URL')
 ZIP_CODES = os.getenv('ZIP_CODES')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_IDS = os.getenv('TELEGRAM_CHAT_IDS')
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY')) if os.getenv('MAX_CONCURRENCY') else None
+HOST_RATE_LIMIT = float(os.getenv('HOST_RATE_LIMIT')) if os.getenv('HOST_RATE_LIMIT') else None
+TELEGRAM_MAX_CONCURRENCY = int(os.getenv('TELEGRAM_MAX_CONCURRENCY')) if os.getenv('TELEGRAM_MAX_CONCURRENCY') else None
+TELEGRAM_GLOBAL_RATE_LIMIT = float(os.getenv('TELEGRAM_GLOBAL_RATE_LIMIT')) if os.getenv('TELEGRAM_GLOBAL_RATE_LIMIT') else None
+TELEGRAM_CHAT_RATE_LIMIT = float(os.getenv('TELEGRAM_CHAT_RATE_LIMIT')) if os.getenv('TELEGRAM_CHAT_RATE_LIMIT') else None
+TELEGRAM_MAX_ATTEMPTS = 3
+APPLE_COOKIE_JAR_FILE = os.getenv('APPLE_COOKIE_JAR_FILE', '/tmp/apple_cookie_jar.json')
+
+# Fetch planning
+FETCH_PLANNER_ENABLED = os.getenv('FETCH_PLANNER_ENABLED', 'true').lower() == 'true'
+PLANNER_REFRESH_INTERVAL = int(os.getenv('PLANNER_REFRESH_INTERVAL')) if os.getenv('PLANNER_REFRESH_INTERVAL') else None
+APPLE_MAX_PARTS_PER_REQUEST = int(os.getenv('APPLE_MAX_PARTS_PER_REQUEST')) if os.getenv('APPLE_MAX_PARTS_PER_REQUEST') else None
+PLANNER_COVERAGE_KEY = '__planner__#coverage'
+
+# Responses that mean "try again later" (541 is Apple's throttling status)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504, 541)
+
+# Part metadata: screen size by model family (checked in order), for buy links
+PART_METADATA_FILE = os.getenv('PART_METADATA_FILE')
+STORAGE_PATTERN = re.compile(r'\d+(GB|TB)', re.IGNORECASE)
+SCREEN_SIZES = (('Pro Max', 6.9), ('Air', 6.5), ('Pro', 6.3))
+DEFAULT_SCREEN_SIZE = 6.3
+
+# Sharded sweeps: a coordinator fans ZIP x part-batch jobs out to worker invocations
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+SHARD_FUNCTION_NAME = os.getenv('SHARD_FUNCTION_NAME')
+SWEEP_DEADLINE = int(os.getenv('SWEEP_DEADLINE')) if os.getenv('SWEEP_DEADLINE') else None
+SWEEP_KEY_PREFIX = '__sweep__#'
+SWEEP_INDEX_KEY = '__sweep__#open'
+SWEEP_TTL = 24 * 3600
+
+# Per-chat filters (see load_subscriptions); chats without one get everything.
+# SUBSCRIPTIONS_JSON holds them inline, for the Lambda image, and wins over SUBSCRIPTIONS_FILE
+SUBSCRIPTIONS_FILE = os.getenv('SUBSCRIPTIONS_FILE')
+SUBSCRIPTIONS_JSON = os.getenv('SUBSCRIPTIONS_JSON')
+
+# Alert coalescing (see AlertBuffer): 0 sends every sweep's changes straight away
+ALERT_COALESCE_WINDOW = int(os.getenv('ALERT_COALESCE_WINDOW')) if os.getenv('ALERT_COALESCE_WINDOW') else None
+URGENT_ALERT_DISTANCE = float(os.getenv('URGENT_ALERT_DISTANCE')) if os.getenv('URGENT_ALERT_DISTANCE') else None
+ALERT_BUFFER_KEY = '__alerts__#pending'
+ALERT_BUFFER_ATTEMPTS = 5
+
+# Telegram Markdown rendering
+MARKDOWN_ESCAPES = str.maketrans({char: f'\\{char}' for char in '_*[]()~`>#+=|{}!'})
+CHANGE_SEPARATOR = "\n\n---\n\n"
+TABLE_SEPARATOR = "\n\n---\n"
+TELEGRAM_MESSAGE_LIMIT = 4096
+CHUNK_HEADER_RESERVE = 96  # Room for the "(i/n)" header and a safety margin
+
+# Fulfillment response fields kept by the streaming parser
+STORES_PREFIX = 'body.content.pickupMessage.stores'
+STORE_FIELDS = ('storeName', 'storelatitude', 'storelongitude', 'city', 'storeDistanceWithUnit', 'storedistance')
+
+# Warm-container cache of the last response per fulfillment URL
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE')) if os.getenv('RESPONSE_CACHE_SIZE') else None
+RESPONSE_SPOOL_MEMORY = 256 * 1024  # Response bodies larger than this are spooled to disk while hashing
+RESPONSE_READ_CHUNK = 64 * 1024
+
+# Returned by fetch_apple_data() when a response matches the last one processed
+RESPONSE_UNCHANGED = object()
+
+# DynamoDB batch API limits
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+MAX_BATCH_ATTEMPTS = 8
+
+# Change-event log: '' (disabled), 'dynamodb' (state table) or 'file' (CHANGE_LOG_DIR)
+CHANGE_LOG_BACKEND = os.getenv('CHANGE_LOG_BACKEND', '').lower()
+CHANGE_LOG_DIR = os.getenv('CHANGE_LOG_DIR', '.changelog')
+CHANGE_LOG_SNAPSHOT_EVERY = int(os.getenv('CHANGE_LOG_SNAPSHOT_EVERY')) if os.getenv('CHANGE_LOG_SNAPSHOT_EVERY') else None
+CHANGE_LOG_HEAD_KEY = '__changelog__#head'
+CHANGE_LOG_SNAPSHOT_KEY = '__changelog__#snapshot'
+CHANGE_LOG_EVENT_PREFIX = '__changelog__#event#'
+SNAPSHOT_MAGIC = b'AVSN'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_UNKNOWN = 255
+MAX_SNAPSHOT_ITEM_BYTES = 380 * 1024  # DynamoDB items max out at 400 KB
+CHANGE_LOG_GAP_TIMEOUT = 120  # Seconds before a reserved but unwritten sequence number is skipped
+
+# Logging and metrics: LOG_LEVEL=DEBUG brings back the per-store/per-part lines
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+VERBOSE = LOG_LEVEL == 'DEBUG'
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'IPhoneStockBot')
+
+# Warm-container availability cache
+STATE_CACHE_SIZE = int(os.getenv('STATE_CACHE_SIZE')) if os.getenv('STATE_CACHE_SIZE') else None
+STATE_CACHE_TTL = int(os.getenv('STATE_CACHE_TTL')) if os.getenv('STATE_CACHE_TTL') else None
 
 # HTTP Headers
+APPLE_API_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:143.0) Gecko/20100101 Firefox/143.0',
+    'Accept': '*/*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br, zstd',
+    'Referer': 'https://www.apple.com/shop/buy-iphone/iphone-17-pro/6.9-inch-display-512gb-deep-blue-unlocked',
+    'x-skip-redirect': 'true',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'empty',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-origin',
+    'Priority': 'u=0'
+}
+
 DEFAULT_HEADERS = {
     'User-Agent': USER_AGENT,
     'Accept': 'application/json, text/plain, */*',
@@ -36,9 +161,813 @@ DEFAULT_HEADERS = {
 }
 
 
-# Initializing a DynamoDB resource
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+# The DynamoDB resource is created on first use: importing boto3 is the bulk
+# of a cold start, and sweeps that fail early never need it
+dynamodb = None
+table = None
+dynamodb_lock = threading.Lock()
+
+
+def get_dynamodb():
+    """Return the DynamoDB resource, honouring DYNAMODB_ENDPOINT_URL for dynamodb-local"""
+    global dynamodb
+    if dynamodb is None:
+        with dynamodb_lock:
+            if dynamodb is None:
+                import boto3
+                if DYNAMODB_ENDPOINT_URL:
+                    dynamodb = boto3.resource('dynamodb', endpoint_url=DYNAMODB_ENDPOINT_URL)
+                else:
+                    dynamodb = boto3.resource('dynamodb')
+    return dynamodb
+
+
+def get_table():
+    """Return the availability state table"""
+    global table
+    if table is None:
+        table = get_dynamodb().Table(DYNAMODB_TABLE_NAME)
+    return table
+
+
+class Metrics:
+    """
+    Per-invocation timing spans and counters
+
+    Spans add up wall-clock milliseconds and a call count under a stage name.
+    Stages that run on several worker threads at once can therefore add up to
+    more than the handler's wall time. Everything is emitted as a single
+    CloudWatch Embedded Metric Format (EMF) log line per invocation.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds * 1000
+            self.counters[f"{name}Calls"] = self.counters.get(f"{name}Calls", 0) + 1
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_emf(self, namespace, service):
+        """
+        Build the EMF record: metric values sit at the top level, and the
+        `_aws` block tells CloudWatch which of them to publish and in which
+        units
+        """
+        with self.lock:
+            timings = {f"{name}Ms": round(value, 3) for name, value in self.timings.items()}
+            counters = dict(self.counters)
+
+        definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in sorted(timings)]
+        definitions += [{'Name': name, 'Unit': 'Bytes' if name.endswith('Bytes') else 'Count'} for name in sorted(counters)]
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': definitions,
+                }],
+            },
+            'Service': service,
+            **timings,
+            **counters,
+        }
+
+    def emit(self, namespace=None, service='iphone-stock-bot'):
+        """Print the EMF record as one JSON line; the Lambda log agent picks it up from stdout"""
+        print(json.dumps(self.to_emf(namespace or METRICS_NAMESPACE, service), separators=(',', ':')))
+
+
+# Reset at the start of every handler invocation
+metrics = Metrics()
+
+
+class RateLimiter:
+    """
+    Spaces out calls sharing the same key (a host, a chat ID, ...) so
+    concurrent workers don't burst
+
+    Each key gets a rolling "next free slot"; callers reserve a slot under the
+    lock and then sleep outside of it, so different keys never block each other.
+    """
+
+    def __init__(self, requests_per_second=None):
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, key):
+        if not self.min_interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(key, now))
+            self.next_slot[key] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryScheduler:
+    """
+    Backoff delays for retrying a request
+
+    Uses exponential backoff with full jitter, so concurrent workers retrying
+    the same host spread out instead of hitting it in lockstep. A Retry-After
+    header from the server takes precedence. Every delay is capped at
+    `max_delay`.
+    """
+
+    def __init__(self, initial_delay, max_delay):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.initial_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker
+
+    After `threshold` consecutive failed attempts against a host the circuit
+    opens. Further requests fail fast until `cooldown` seconds pass; then a
+    single trial request is let through. Success closes the circuit, and
+    failure re-opens it.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened_at = {}
+
+    def allow(self, key):
+        with self.lock:
+            opened_at = self.opened_at.get(key)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at >= self.cooldown:
+                # Half-open: re-arm so only this caller gets the trial request
+                self.opened_at[key] = time.monotonic()
+                return True
+            return False
+
+    def is_open(self, key):
+        with self.lock:
+            return key in self.opened_at
+
+    def record_success(self, key):
+        with self.lock:
+            self.failures[key] = 0
+            self.opened_at.pop(key, None)
+
+    def record_failure(self, key):
+        with self.lock:
+            self.failures[key] = self.failures.get(key, 0) + 1
+            if self.failures[key] >= self.threshold:
+                if key not in self.opened_at:
+                    print(f"⚡ Circuit opened for {key} after {self.failures[key]} consecutive failures")
+                self.opened_at[key] = time.monotonic()
+
+
+# Shared across all worker threads of an invocation (and warm invocations)
+host_rate_limiter = RateLimiter(HOST_RATE_LIMIT or 2)
+apple_retry_scheduler = RetryScheduler(INITIAL_RETRY_DELAY or 1, RETRY_MAX_DELAY or 30)
+apple_circuit_breaker = CircuitBreaker(CIRCUIT_BREAKER_THRESHOLD or 5, CIRCUIT_BREAKER_COOLDOWN or 120)
+telegram_global_limiter = RateLimiter(TELEGRAM_GLOBAL_RATE_LIMIT or 25)
+telegram_chat_limiter = RateLimiter(TELEGRAM_CHAT_RATE_LIMIT or 1)
+
+# Pooled keep-alive session for Telegram, created on first send
+telegram_session = None
+telegram_session_lock = threading.Lock()
+
+# Apple sessions are built once per container and rebuilt only when the
+# configured cookies change
+apple_session_pool = None
+apple_session_pool_lock = threading.Lock()
+cookie_file_cache = None
+
+
+def _unprocessed_backoff(attempt):
+    """Sleep before resubmitting unprocessed batch items (exponential, capped at 2s)"""
+    time.sleep(min(0.05 * (2 ** attempt), 2))
+
+
+def batch_get_items(keys):
+    """
+    Load DynamoDB items for the given IDs with BatchGetItem
+
+    Keys are de-duplicated and requested in chunks of BATCH_GET_LIMIT;
+    UnprocessedKeys are resubmitted with backoff.
+
+    Returns:
+        Dict mapping ID to item for every key that exists in the table
+    """
+    items = {}
+    unique_keys = list(dict.fromkeys(keys))
+
+    for i in range(0, len(unique_keys), BATCH_GET_LIMIT):
+        chunk = unique_keys[i:i + BATCH_GET_LIMIT]
+        request = {get_table().name: {'Keys': [{'ID': key} for key in chunk], 'ConsistentRead': True}}
+
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            with metrics.span('DynamoDBRead'):
+                response = get_dynamodb().batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(get_table().name, []):
+                items[item['ID']] = item
+
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            _unprocessed_backoff(attempt)
+        else:
+            raise RuntimeError(f"BatchGetItem left keys unprocessed after {MAX_BATCH_ATTEMPTS} attempts")
+
+    return items
+
+
+def batch_write_items(items):
+    """
+    Write items with BatchWriteItem in chunks of BATCH_WRITE_LIMIT
+
+    UnprocessedItems are resubmitted with backoff. Later items win when the
+    same ID is queued twice, since a batch may not contain duplicate keys.
+    """
+    unique_items = list({item['ID']: item for item in items}.values())
+
+    for i in range(0, len(unique_items), BATCH_WRITE_LIMIT):
+        chunk = unique_items[i:i + BATCH_WRITE_LIMIT]
+        request = {get_table().name: [{'PutRequest': {'Item': item}} for item in chunk]}
+
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            with metrics.span('DynamoDBWrite'):
+                response = get_dynamodb().batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems')
+            if not request:
+                break
+            _unprocessed_backoff(attempt)
+        else:
+            raise RuntimeError(f"BatchWriteItem left items unprocessed after {MAX_BATCH_ATTEMPTS} attempts")
+
+
+def batch_delete_items(keys):
+    """Delete items by ID with BatchWriteItem in chunks of BATCH_WRITE_LIMIT"""
+    unique_keys = list(dict.fromkeys(keys))
+
+    for i in range(0, len(unique_keys), BATCH_WRITE_LIMIT):
+        chunk = unique_keys[i:i + BATCH_WRITE_LIMIT]
+        request = {get_table().name: [{'DeleteRequest': {'Key': {'ID': key}}} for key in chunk]}
+
+        for attempt in range(MAX_BATCH_ATTEMPTS):
+            with metrics.span('DynamoDBWrite'):
+                response = get_dynamodb().batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems')
+            if not request:
+                break
+            _unprocessed_backoff(attempt)
+        else:
+            raise RuntimeError(f"BatchWriteItem left deletes unprocessed after {MAX_BATCH_ATTEMPTS} attempts")
+
+
+class AvailabilityCache:
+    """
+    Size-bounded LRU of the last known availability per model@store key
+
+    Lives at module level so it survives between invocations of a warm Lambda
+    container. Entries expire after `ttl` seconds so rows changed by another
+    container are eventually re-read from DynamoDB.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns (found, availability)"""
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[0]
+
+    def put(self, key, availability):
+        self.entries[key] = (availability, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+availability_cache = AvailabilityCache(STATE_CACHE_SIZE or 5000, STATE_CACHE_TTL or 300)
+
+
+class AvailabilityState:
+    """
+    In-memory view of the model@store availability rows for one sweep
+
+    Rows are loaded in bulk with load(), compared in memory with record(),
+    and only the changed ones are written back by flush(). Reads are served
+    from `cache` when possible and writes go through to it. With `use_cache`
+    off every row is read from DynamoDB and the cache is left alone.
+    """
+
+    def __init__(self, cache=None, use_cache=True):
+        self.cache = (cache if cache is not None else availability_cache) if use_cache else None
+        self.known = {}
+        self.pending = {}
+        self.previous = {}
+
+    def load(self, keys):
+        missing = []
+        for key in dict.fromkeys(keys):
+            if key in self.known:
+                continue
+            found, availability = self.cache.get(key) if self.cache else (False, None)
+            if found:
+                self.known[key] = availability
+            else:
+                missing.append(key)
+
+        if not missing:
+            return
+
+        items = batch_get_items(missing)
+        for key in missing:
+            item = items.get(key)
+            self.known[key] = item.get('availability') if item else None
+            if self.cache:
+                self.cache.put(key, self.known[key])
+
+    def record(self, key, availability, record):
+        """Queue `record` if `availability` differs from the stored value; returns True on change"""
+        if key not in self.known:
+            self.load([key])
+
+        if self.known[key] == availability:
+            return False
+
+        self.previous.setdefault(key, self.known[key])
+        self.known[key] = availability
+        self.pending[key] = record
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        print(f"Writing {len(self.pending)} changed availability rows")
+        batch_write_items([record.to_item() for record in self.pending.values()])
+        if self.cache:
+            for key, record in self.pending.items():
+                self.cache.put(key, record.availability)
+
+        log = get_change_log()
+        if log:
+            changes = [(key, self.previous.get(key), record.availability) for key, record in self.pending.items()
+                       if self.previous.get(key) != record.availability]
+            try:
+                with metrics.span('ChangeLogAppend'):
+                    log.append(changes)
+            except Exception as e:
+                # The rows above are the source of truth; a missing event only costs history
+                print(f"Failed to append {len(changes)} change events: {e}")
+
+        self.pending = {}
+        self.previous = {}
+
+
+@dataclass(slots=True)
+class ChangeEvent:
+    """One availability transition of a model@store key; an empty key fills a sequence number whose write failed"""
+    seq: int
+    timestamp: int
+    key: str
+    old: str
+    new: str
+
+    def to_dict(self):
+        return {'seq': self.seq, 'ts': self.timestamp, 'key': self.key, 'old': self.old, 'new': self.new}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(int(data['seq']), int(data['ts']), data['key'], data.get('old'), data.get('new'))
+
+
+def pack_snapshot(seq, view):
+    """
+    Encode the materialized view as a compact columnar blob
+
+    Layout (little-endian, zlib-compressed as a whole):
+        header   '<4sHQI'  magic, format version, last applied seq, key count
+        values   uint8 count, then uint8-length-prefixed UTF-8 strings
+        keys     uint32 byte length, then newline-joined UTF-8 keys
+        columns  uint8 availability codes (index into values, 255 = unknown),
+                 uint32 changed_at, uint32 last_available_at (0 = never)
+
+    Args:
+        seq: Sequence number of the last event folded into `view`
+        view: Dict mapping key to (availability, changed_at, last_available_at)
+
+    Returns:
+        bytes
+    """
+    keys = sorted(view)
+    values = sorted({view[key][0] for key in keys if view[key][0] is not None})
+    value_codes = {value: code for code, value in enumerate(values)}
+
+    codes = bytes(value_codes.get(view[key][0], SNAPSHOT_UNKNOWN) for key in keys)
+    changed_at = array('I', (view[key][1] for key in keys))
+    last_available_at = array('I', (view[key][2] or 0 for key in keys))
+    if sys.byteorder == 'big':
+        changed_at.byteswap()
+        last_available_at.byteswap()
+
+    encoded_keys = '\n'.join(keys).encode('utf-8')
+    parts = [struct.pack('<4sHQI', SNAPSHOT_MAGIC, SNAPSHOT_VERSION, seq, len(keys)), bytes([len(values)])]
+    for value in values:
+        encoded = value.encode('utf-8')
+        parts.append(bytes([len(encoded)]) + encoded)
+    parts += [struct.pack('<I', len(encoded_keys)), encoded_keys, codes, changed_at.tobytes(), last_available_at.tobytes()]
+    return zlib.compress(b''.join(parts))
+
+
+def unpack_snapshot(blob):
+    """
+    Decode a pack_snapshot() blob
+
+    Returns:
+        (seq, view)
+    """
+    data = zlib.decompress(blob)
+    magic, version, seq, count = struct.unpack_from('<4sHQI', data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {magic!r} v{version}")
+    offset = struct.calcsize('<4sHQI')
+
+    values = []
+    for _ in range(data[offset]):
+        length = data[offset + 1]
+        values.append(data[offset + 2:offset + 2 + length].decode('utf-8'))
+        offset += 1 + length
+    offset += 1
+
+    (keys_length,) = struct.unpack_from('<I', data, offset)
+    offset += 4
+    keys = data[offset:offset + keys_length].decode('utf-8').split('\n') if count else []
+    offset += keys_length
+
+    codes = data[offset:offset + count]
+    offset += count
+    changed_at = array('I', data[offset:offset + 4 * count])
+    offset += 4 * count
+    last_available_at = array('I', data[offset:offset + 4 * count])
+    if sys.byteorder == 'big':
+        changed_at.byteswap()
+        last_available_at.byteswap()
+
+    view = {}
+    for i, key in enumerate(keys):
+        availability = values[codes[i]] if codes[i] != SNAPSHOT_UNKNOWN else None
+        view[key] = (availability, changed_at[i], last_available_at[i] or None)
+    return seq, view
+
+
+class ChangeLog(ABC):
+    """
+    Append-only log of availability changes with periodic packed snapshots
+
+    Keeps a materialized view (key -> (availability, changed_at,
+    last_available_at)) in memory. A cold container loads the latest snapshot
+    and replays only the events written after it, rather than reading every
+    model@store row. `seq` is the highest sequence number up to which every
+    event has been applied. A sequence number that was reserved but never
+    written is skipped once it has been missing for CHANGE_LOG_GAP_TIMEOUT.
+
+    Storage is provided by subclasses through _head(), _reserve(),
+    _write_events(), _read_events(), _read_snapshot() and _write_snapshot().
+    """
+
+    def __init__(self, snapshot_every):
+        self.snapshot_every = snapshot_every
+        self.started = False
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.view = {}
+        self.gaps = {}
+
+    def apply(self, event):
+        if not event.key:
+            return
+        _, _, last_available_at = self.view.get(event.key, (None, 0, None))
+        if event.new == 'available':
+            last_available_at = event.timestamp
+        self.view[event.key] = (event.new, event.timestamp, last_available_at)
+
+    def last_available_at(self, key):
+        """Epoch seconds when `key` last turned available, or None"""
+        return self.view.get(key, (None, 0, None))[2]
+
+    def sync(self, cache=None):
+        """
+        Catch up with events written since the last sync (on first use: load
+        the snapshot, then replay its tail), then refresh `cache`
+
+        The first sync warms `cache` with every key in the view. Later syncs
+        only refresh the keys they replayed: the view misses any change whose
+        events were lost, and re-putting it would keep a stale value cached
+        past STATE_CACHE_TTL in place of a fresh read.
+
+        Returns:
+            Number of events replayed
+        """
+        cold = not self.started
+        if cold:
+            blob = self._read_snapshot()
+            if blob:
+                try:
+                    self.seq, self.view = unpack_snapshot(blob)
+                except (ValueError, struct.error, zlib.error) as e:
+                    print(f"Ignoring unreadable change log snapshot: {e}")
+                    self.seq, self.view = 0, {}
+                self.snapshot_seq = self.seq
+            self.started = True
+
+        head = self._head()
+        events = self._read_events(self.seq + 1, head) if head > self.seq else []
+        written = set()
+        for event in events:
+            self.apply(event)
+            written.add(event.seq)
+
+        # Only advance over a contiguous run; a gap is a reservation whose events aren't written yet,
+        # unless it has stayed missing long enough that its writer must have failed
+        now = time.monotonic()
+        while self.seq < head:
+            next_seq = self.seq + 1
+            if next_seq not in written:
+                first_missing = self.gaps.setdefault(next_seq, now)
+                if now - first_missing < CHANGE_LOG_GAP_TIMEOUT:
+                    break
+                print(f"Skipping change log seq {next_seq}, reserved {now - first_missing:.0f}s ago but never written")
+                metrics.incr('ChangeLogGapsSkipped')
+            self.gaps.pop(next_seq, None)
+            self.seq = next_seq
+
+        if cache is not None:
+            keys = self.view if cold else {event.key for event in events if event.key}
+            for key in keys:
+                cache.put(key, self.view[key][0])
+        return len(events)
+
+    def append(self, changes):
+        """
+        Write one event per (key, old, new) change, then snapshot if enough
+        events have accumulated since the last one
+        """
+        if not changes:
+            return
+
+        timestamp = int(time.time())
+        first = self._reserve(len(changes))
+        events = [ChangeEvent(first + i, timestamp, key, old, new) for i, (key, old, new) in enumerate(changes)]
+        try:
+            self._write_events(events)
+        except Exception:
+            # Fill the reserved range so readers can move past it; if this fails too, they skip it after a timeout
+            try:
+                self._write_events([ChangeEvent(event.seq, timestamp, '', None, None) for event in events])
+            except Exception as e:
+                print(f"Could not fill change log seq {first}-{events[-1].seq} after a failed write: {e}")
+            # The rows were written, so our own view (and any snapshot taken from it) still gets the changes
+            for event in events:
+                self.apply(event)
+            raise
+
+        if first == self.seq + 1:
+            for event in events:
+                self.apply(event)
+            self.seq = events[-1].seq
+        else:
+            # Another writer appended in between; replay its events and ours in order
+            self.sync()
+
+        if self.seq - self.snapshot_seq >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        blob = pack_snapshot(self.seq, self.view)
+        if self._write_snapshot(blob):
+            print(f"Wrote change log snapshot at seq {self.seq} ({len(self.view)} keys, {len(blob)} bytes)")
+            self.snapshot_seq = self.seq
+            metrics.incr('ChangeLogSnapshots')
+
+    @abstractmethod
+    def _head(self):
+        pass
+
+    @abstractmethod
+    def _reserve(self, count):
+        pass
+
+    @abstractmethod
+    def _write_events(self, events):
+        pass
+
+    @abstractmethod
+    def _read_events(self, first, last):
+        pass
+
+    @abstractmethod
+    def _read_snapshot(self):
+        pass
+
+    @abstractmethod
+    def _write_snapshot(self, blob):
+        pass
+
+
+class DynamoDBChangeLog(ChangeLog):
+    """
+    Change log stored in the availability state table
+
+    The head item holds the last reserved sequence number, bumped atomically
+    so concurrent writers never share one. Events are items keyed by their
+    zero-padded sequence number, so the tail after a snapshot is fetched with
+    BatchGetItem instead of a scan. The snapshot is a single binary item.
+    """
+
+    def _head(self):
+        with metrics.span('DynamoDBRead'):
+            item = get_table().get_item(Key={'ID': CHANGE_LOG_HEAD_KEY}, ConsistentRead=True).get('Item')
+        return int(item['seq']) if item else 0
+
+    def _reserve(self, count):
+        with metrics.span('DynamoDBWrite'):
+            response = get_table().update_item(
+                Key={'ID': CHANGE_LOG_HEAD_KEY},
+                UpdateExpression='ADD seq :count',
+                ExpressionAttributeValues={':count': count},
+                ReturnValues='UPDATED_NEW',
+            )
+        return int(response['Attributes']['seq']) - count + 1
+
+    def _write_events(self, events):
+        batch_write_items([{'ID': CHANGE_LOG_EVENT_PREFIX + f"{event.seq:012d}", **event.to_dict()} for event in events])
+
+    def _read_events(self, first, last):
+        items = batch_get_items([CHANGE_LOG_EVENT_PREFIX + f"{seq:012d}" for seq in range(first, last + 1)])
+        return sorted((ChangeEvent.from_dict(item) for item in items.values()), key=attrgetter('seq'))
+
+    def _read_snapshot(self):
+        with metrics.span('DynamoDBRead'):
+            item = get_table().get_item(Key={'ID': CHANGE_LOG_SNAPSHOT_KEY}, ConsistentRead=True).get('Item')
+        return bytes(item['data']) if item else None
+
+    def _write_snapshot(self, blob):
+        if len(blob) > MAX_SNAPSHOT_ITEM_BYTES:
+            print(f"Change log snapshot is {len(blob)} bytes, over the DynamoDB item limit; keeping the previous one")
+            return False
+        with metrics.span('DynamoDBWrite'):
+            get_table().put_item(Item={'ID': CHANGE_LOG_SNAPSHOT_KEY, 'seq': self.seq, 'data': blob})
+        return True
+
+
+class FileChangeLog(ChangeLog):
+    """
+    Change log kept in a local directory, for running and testing offline
+
+    Events are appended to events.jsonl, one JSON object per line, and the
+    snapshot is replaced atomically in snapshot.bin. Assumes a single writer.
+    The file is read incrementally from the last byte offset, keeping events
+    that haven't been applied yet, so a sync doesn't re-parse the whole log.
+    """
+
+    def __init__(self, directory, snapshot_every):
+        super().__init__(snapshot_every)
+        self.events_file = os.path.join(directory, 'events.jsonl')
+        self.snapshot_file = os.path.join(directory, 'snapshot.bin')
+        self.offset = 0
+        self.head = 0
+        self.unread = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _scan(self):
+        """Parse the complete lines appended since the last scan"""
+        try:
+            with open(self.events_file, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # A line without its newline is still being written; pick it up next time
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        for line in data[:end].splitlines():
+            if line.strip():
+                event = ChangeEvent.from_dict(json.loads(line))
+                self.head = max(self.head, event.seq)
+                if event.seq > self.seq:
+                    self.unread[event.seq] = event
+
+    def _head(self):
+        self._scan()
+        return self.head
+
+    def _reserve(self, count):
+        return max(self._head(), self.seq) + 1
+
+    def _write_events(self, events):
+        with open(self.events_file, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event.to_dict()) + '\n')
+
+    def _read_events(self, first, last):
+        self._scan()
+        # Events before `first` have been applied; later ones stay until a sync gets past any gap before them
+        self.unread = {seq: event for seq, event in self.unread.items() if seq >= first}
+        return [self.unread[seq] for seq in sorted(self.unread) if seq <= last]
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_snapshot(self, blob):
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_file, self.snapshot_file)
+        return True
+
+
+# Chosen by CHANGE_LOG_BACKEND; None when the change log is disabled
+change_log = None
+
+
+def get_change_log():
+    """Return the container-wide change log, or None if CHANGE_LOG_BACKEND is unset"""
+    global change_log
+    if change_log is None:
+        if CHANGE_LOG_BACKEND == 'dynamodb':
+            change_log = DynamoDBChangeLog(CHANGE_LOG_SNAPSHOT_EVERY or 500)
+        elif CHANGE_LOG_BACKEND == 'file':
+            change_log = FileChangeLog(CHANGE_LOG_DIR, CHANGE_LOG_SNAPSHOT_EVERY or 500)
+        elif CHANGE_LOG_BACKEND:
+            print(f"Unknown CHANGE_LOG_BACKEND {CHANGE_LOG_BACKEND!r}, change log disabled")
+    return change_log
 
 
 def construct_apple_url(location=None, models_csv=None):
@@ -68,17 +997,595 @@ def construct_apple_url(location=None, models_csv=None):
     return url
 
 
+@dataclass(slots=True)
+class Availability:
+    """
+    One part at one store, as parsed from a fulfillment response
+
+    Numeric fields are parsed once here and `sort_key` is precomputed, so
+    sorting and de-duplicating thousands of records doesn't re-convert
+    strings. Markdown is only produced by format_change() /
+    format_available_line() when a message is actually sent.
+    """
+    key: str
+    availability: str
+    model: str
+    store: str
+    zip_code: str
+    city: str
+    distance: float
+    distance_label: str
+    screen_size: float
+    color: str
+    storage: str
+    maps_link: str
+    buy_url: str
+    part: str = ''
+    sort_key: tuple = field(init=False)
+
+    def __post_init__(self):
+        self.sort_key = (self.distance, self.screen_size, self.color)
+
+    @property
+    def is_available(self):
+        return self.availability == 'available'
+
+    def to_dict(self):
+        """JSON-safe dict of the constructor fields, for passing records between invocations"""
+        return {name: getattr(self, name) for name in AVAILABILITY_FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data[name] for name in AVAILABILITY_FIELDS if name in data})
+
+    def to_item(self):
+        """DynamoDB item for the model@store state row"""
+        return {
+            'ID': self.key,
+            'availability': self.availability,
+            'city': self.city,
+            'distance': Decimal(str(self.distance)),
+            'screen_size': Decimal(str(self.screen_size)),
+            'color': self.color,
+            'storage': self.storage
+        }
+
+
+AVAILABILITY_FIELDS = tuple(f.name for f in fields(Availability) if f.init)
+
+
+@dataclass(slots=True, frozen=True)
+class PartMetadata:
+    """Everything derived from a part number's product title, worked out once per part"""
+    model: str
+    storage: str
+    color: str
+    screen_size: float
+    buy_slug: str
+
+    @classmethod
+    def from_title(cls, title):
+        """
+        Parse a pickup title such as "iPhone 17 Pro Max 256GB Deep Blue"
+
+        Everything after the storage token is the colour. The screen size
+        comes from the model family (see SCREEN_SIZES).
+        """
+        words = title.split()
+        storage_at = next((i for i, word in enumerate(words) if STORAGE_PATTERN.fullmatch(word)), None)
+        if storage_at is None:
+            return cls(title, '', '', DEFAULT_SCREEN_SIZE, '')
+
+        storage = words[storage_at].lower()
+        color = '-'.join(words[storage_at + 1:]).lower()
+        family = ' '.join(words[:storage_at])
+        screen_size = next((size for name, size in SCREEN_SIZES if name in family), DEFAULT_SCREEN_SIZE)
+        return cls(title, storage, color, screen_size, f"{screen_size:g}-inch-display-{storage}-{color}-unlocked")
+
+
+class PartIndex:
+    """
+    Part number -> PartMetadata, kept for the container lifetime
+
+    Parts repeat across every store and ZIP code, so each title is parsed
+    the first time its part shows up and every later row is a dict lookup.
+    Entries from a PART_METADATA_FILE seed take precedence over titles from
+    responses.
+    """
+
+    def __init__(self, parts=None):
+        self.parts = parts or {}
+
+    @classmethod
+    def load(cls, path):
+        """
+        Build the index from a JSON seed file keyed by IPHONE_MODELS part
+        number. Values are either a product title or an object with a `title`
+        and optional `storage`, `color`, `screen_size` and `buy_slug`
+        overrides.
+        """
+        parts = {}
+        if not path:
+            return cls(parts)
+
+        try:
+            with open(path, 'r') as f:
+                seed = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading part metadata file {path}: {e}")
+            return cls(parts)
+
+        for part, entry in seed.items():
+            if isinstance(entry, str):
+                entry = {'title': entry}
+            metadata = PartMetadata.from_title(entry['title'])
+            overrides = {name: entry[name] for name in ('storage', 'color', 'screen_size', 'buy_slug') if name in entry}
+            parts[part] = replace(metadata, **overrides) if overrides else metadata
+
+        print(f"Loaded metadata for {len(parts)} parts from {path}")
+        return cls(parts)
+
+    def lookup(self, part, details):
+        """
+        Metadata for `part`, parsing the title in `details` on first sight
+
+        Parts that arrive without a title get a placeholder that isn't cached,
+        so a later response carrying the title can still fill the entry in.
+        """
+        metadata = self.parts.get(part)
+        if metadata is not None:
+            return metadata
+
+        message_types = details.get('messageTypes', {})
+        title = (message_types.get('compact') or message_types.get('regular') or {}).get('storePickupProductTitle')
+        if not title:
+            return PartMetadata(f"iPhone Model {part}", '', '', DEFAULT_SCREEN_SIZE, '')
+
+        metadata = self.parts[part] = PartMetadata.from_title(title)
+        return metadata
+
+
+# Built from PART_METADATA_FILE on first use and then grown from responses
+part_index = None
+
+
+def get_part_index():
+    global part_index
+    if part_index is None:
+        part_index = PartIndex.load(PART_METADATA_FILE)
+    return part_index
+
+
+def split_part_batches(models_csv=None):
+    """
+    Split the configured model codes into batches of at most
+    APPLE_MAX_PARTS_PER_REQUEST parts
+
+    Returns:
+        List of comma-separated model code strings, one per request
+    """
+    if models_csv is None:
+        models_csv = IPHONE_MODELS
+    models = [model.strip() for model in models_csv.split(',') if model.strip()]
+    batch_size = APPLE_MAX_PARTS_PER_REQUEST or len(models) or 1
+    return [','.join(models[i:i + batch_size]) for i in range(0, len(models), batch_size)]
+
+
+class FetchPlanner:
+    """
+    Picks the fewest ZIP codes whose responses cover every known store
+
+    Neighbouring ZIPs return heavily overlapping store lists, so once we know
+    which stores each ZIP returns we only need a set cover of them. Coverage
+    is learned from responses and stored as a single item in the state table.
+    ZIPs we have never fetched, or whose coverage is older than
+    PLANNER_REFRESH_INTERVAL, are always fetched so the index keeps up with
+    Apple.
+    """
+
+    def __init__(self, coverage=None):
+        self.coverage = coverage or {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls):
+        try:
+            with metrics.span('DynamoDBRead'):
+                item = get_table().get_item(Key={'ID': PLANNER_COVERAGE_KEY}).get('Item')
+        except Exception as e:
+            print(f"Could not load fetch planner coverage, fetching every ZIP: {e}")
+            return cls()
+        return cls(json.loads(item['coverage']) if item else None)
+
+    def save(self):
+        if not self.dirty:
+            return
+        with metrics.span('DynamoDBWrite'):
+            get_table().put_item(Item={'ID': PLANNER_COVERAGE_KEY, 'coverage': json.dumps(self.coverage, sort_keys=True)})
+        self.dirty = False
+
+    def learn(self, zip_code, distances):
+        """Record the stores a ZIP's response returned, with their distances from it"""
+        stores = sorted(distances)
+        entry = self.coverage.get(zip_code)
+        if (entry and entry['stores'] == stores and 'distances' in entry
+                and time.time() - entry['learned_at'] < (PLANNER_REFRESH_INTERVAL or 3600) / 2):
+            return
+        self.coverage[zip_code] = {'stores': stores, 'distances': distances, 'learned_at': int(time.time())}
+        self.dirty = True
+
+    def plan(self, zip_codes):
+        """
+        Choose which ZIP codes to fetch this sweep
+
+        Returns:
+            Subset of `zip_codes`, in their configured order
+        """
+        now = time.time()
+        refresh_interval = PLANNER_REFRESH_INTERVAL or 3600
+
+        selected = set()
+        covered = set()
+        candidates = []
+        for zip_code in zip_codes:
+            entry = self.coverage.get(zip_code)
+            if entry is None or now - entry['learned_at'] > refresh_interval:
+                selected.add(zip_code)
+                covered.update(entry['stores'] if entry else ())
+            else:
+                candidates.append(zip_code)
+
+        wanted = set()
+        for zip_code in zip_codes:
+            wanted.update(self.coverage.get(zip_code, {}).get('stores', ()))
+
+        # Greedy set cover; ties go to the ZIP listed first
+        while candidates and wanted - covered:
+            best = max(candidates, key=lambda z: len(set(self.coverage[z]['stores']) - covered))
+            if not set(self.coverage[best]['stores']) - covered:
+                break
+            selected.add(best)
+            covered.update(self.coverage[best]['stores'])
+            candidates.remove(best)
+
+        return [zip_code for zip_code in zip_codes if zip_code in selected]
+
+
+@dataclass(slots=True, frozen=True)
+class Subscription:
+    """
+    What one Telegram chat wants to hear about; empty filters match everything
+
+    zip_codes and max_distance are checked against the distances each ZIP's
+    response reports for a store. models (IPHONE_MODELS part numbers), colors
+    and storage are checked against the part.
+    """
+    chat_id: str
+    zip_codes: frozenset = frozenset()
+    max_distance: float = None
+    models: frozenset = frozenset()
+    colors: frozenset = frozenset()
+    storage: frozenset = frozenset()
+
+    @classmethod
+    def from_dict(cls, chat_id, data):
+        """
+        Raises:
+            ValueError: If `data` isn't an object, a filter isn't a list, or
+                max_distance isn't a number
+        """
+        if not isinstance(data, dict):
+            raise ValueError(f"expected an object, got {type(data).__name__}")
+        for name in ('zip_codes', 'models', 'colors', 'storage'):
+            if not isinstance(data.get(name, []), list):
+                raise ValueError(f"{name} must be a list")
+        max_distance = data.get('max_distance')
+        if max_distance is not None:
+            try:
+                max_distance = float(max_distance)
+            except (TypeError, ValueError):
+                raise ValueError(f"max_distance must be a number, got {max_distance!r}") from None
+
+        def normalized(name):
+            return frozenset(str(value).strip().lower().replace(' ', '-') for value in data.get(name, ()))
+
+        return cls(
+            chat_id=str(chat_id),
+            zip_codes=frozenset(str(zip_code).strip() for zip_code in data.get('zip_codes', ())),
+            max_distance=max_distance,
+            models=frozenset(str(model).strip() for model in data.get('models', ())),
+            colors=normalized('colors'),
+            storage=normalized('storage'),
+        )
+
+    @property
+    def matches_everything(self):
+        return not (self.zip_codes or self.max_distance is not None or self.models or self.colors or self.storage)
+
+    def accepts_part(self, part, color, storage):
+        return ((not self.models or part in self.models)
+                and (not self.colors or color in self.colors)
+                and (not self.storage or storage in self.storage))
+
+    def accepts_store(self, distances):
+        """
+        Args:
+            distances: Dict mapping each configured ZIP code that returns the
+                store to its distance from that ZIP
+        """
+        if self.zip_codes:
+            distances = [distance for zip_code, distance in distances.items() if zip_code in self.zip_codes]
+        else:
+            distances = list(distances.values())
+        if not distances:
+            return False
+        return self.max_distance is None or min(distances) <= self.max_distance
+
+
+def load_subscriptions(path, chat_ids, inline=None):
+    """
+    Build one Subscription per recipient
+
+    The filters come from `inline` JSON when given, otherwise from the file
+    at `path`. Either is a JSON object keyed by chat ID, e.g.
+    {"12345": {"zip_codes": ["10001"], "max_distance": 15, "models": ["MFXG4LL/A"],
+               "colors": ["deep blue"], "storage": ["256GB"]}}.
+    Chats listed in TELEGRAM_CHAT_IDS without an entry get everything.
+
+    Returns:
+        List of Subscription, in recipient order
+    """
+    entries = {}
+    if inline:
+        try:
+            entries = json.loads(inline)
+        except ValueError as e:
+            print(f"Error parsing SUBSCRIPTIONS_JSON, sending everything to everyone: {e}")
+    elif path:
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading subscriptions file {path}, sending everything to everyone: {e}")
+
+    if not isinstance(entries, dict):
+        print("Subscriptions must be a JSON object keyed by chat ID, sending everything to everyone")
+        entries = {}
+
+    subscriptions = {chat_id: Subscription(chat_id) for chat_id in chat_ids}
+    for chat_id, data in entries.items():
+        try:
+            subscriptions[str(chat_id)] = Subscription.from_dict(chat_id, data)
+        except ValueError as e:
+            print(f"Ignoring the subscription for chat {chat_id}, sending it everything: {e}")
+    return list(subscriptions.values())
+
+
+class SubscriptionRouter:
+    """
+    Inverted index from (part, store) to the chats subscribed to it
+
+    Built once per sweep from the subscriptions and the planner's coverage,
+    which records every configured ZIP's stores and their distances, so
+    stores seen only through another ZIP's response still route correctly.
+    Part filters are resolved once per part and store filters once per
+    (part, store); every change after that is a dict lookup.
+    """
+
+    def __init__(self, subscriptions, coverage):
+        self.subscriptions = subscriptions
+        self.chat_ids = frozenset(subscription.chat_id for subscription in subscriptions)
+        self.everyone = all(subscription.matches_everything for subscription in subscriptions)
+
+        self.distances = {}
+        for zip_code, entry in coverage.items():
+            for store, distance in entry.get('distances', {}).items():
+                self.distances.setdefault(store, {})[zip_code] = distance
+
+        self.by_part = {}
+        self.routes = {}
+
+    def route(self, row):
+        """Chat IDs that should see `row`"""
+        if self.everyone:
+            return self.chat_ids
+
+        route_key = (row.part, row.store)
+        chat_ids = self.routes.get(route_key)
+        if chat_ids is None:
+            part_subscriptions = self.by_part.get(row.part)
+            if part_subscriptions is None:
+                part_subscriptions = self.by_part[row.part] = [
+                    subscription for subscription in self.subscriptions
+                    if subscription.accepts_part(row.part, row.color, row.storage)
+                ]
+            distances = self.distances.get(row.store, {})
+            chat_ids = self.routes[route_key] = frozenset(
+                subscription.chat_id for subscription in part_subscriptions if subscription.accepts_store(distances)
+            )
+        return chat_ids
+
+    def views(self, change_groups, available_items):
+        """
+        Group recipients by the exact alert they should get
+
+        Each change and available row is routed once. Chats whose filters
+        select the same rows share one view, so it is rendered once no matter
+        how many chats receive it. Chats with no matching changes get nothing.
+
+        Returns:
+            List of (chat_ids, change_groups, available_items)
+        """
+        changes_by_chat = {}
+        for group_index, (zip_code, area_city, changes) in enumerate(change_groups):
+            for change_index, row in enumerate(changes):
+                for chat_id in self.route(row):
+                    changes_by_chat.setdefault(chat_id, []).append((group_index, change_index))
+
+        available_by_chat = {}
+        for item_index, row in enumerate(available_items):
+            for chat_id in self.route(row):
+                if chat_id in changes_by_chat:
+                    available_by_chat.setdefault(chat_id, []).append(item_index)
+
+        chats_by_view = {}
+        for chat_id, change_indexes in changes_by_chat.items():
+            view_key = (tuple(change_indexes), tuple(available_by_chat.get(chat_id, ())))
+            chats_by_view.setdefault(view_key, []).append(chat_id)
+
+        views = []
+        for (change_indexes, item_indexes), chat_ids in chats_by_view.items():
+            selected = {}
+            for group_index, change_index in change_indexes:
+                selected.setdefault(group_index, []).append(change_groups[group_index][2][change_index])
+            groups = [(change_groups[i][0], change_groups[i][1], rows) for i, rows in selected.items()]
+            views.append((sorted(chat_ids), groups, [available_items[i] for i in item_indexes]))
+        return views
+
+
+# Loaded from SUBSCRIPTIONS_FILE on first use
+subscriptions = None
+
+
+def get_subscriptions():
+    global subscriptions
+    if subscriptions is None:
+        chat_ids = [chat_id.strip() for chat_id in TELEGRAM_CHAT_IDS.split(',') if chat_id.strip()] if TELEGRAM_CHAT_IDS else []
+        subscriptions = load_subscriptions(SUBSCRIPTIONS_FILE, chat_ids, SUBSCRIPTIONS_JSON)
+    return subscriptions
+
+
+class AlertBuffer:
+    """
+    Changes held back so flapping stock produces at most one alert per window
+
+    Each buffered model@store key keeps its baseline, the availability it had
+    before it was first buffered (what chats were last told), and its latest
+    row. A key that flips back to its baseline drops out, so a store that
+    flickers within the window never reaches Telegram. The buffer is a single
+    item in the state table, written only when it changes and only if its
+    version hasn't moved on since it was loaded, so overlapping invocations
+    can't overwrite each other's changes.
+    """
+
+    def __init__(self, opened_at=None, entries=None, version=0):
+        self.opened_at = opened_at
+        self.entries = entries or {}
+        self.version = version
+        self.dirty = False
+
+    @classmethod
+    def load(cls):
+        """Returns the stored buffer, or None if it can't be read"""
+        try:
+            with metrics.span('DynamoDBRead'):
+                item = get_table().get_item(Key={'ID': ALERT_BUFFER_KEY}, ConsistentRead=True).get('Item')
+        except Exception as e:
+            print(f"Could not load the alert buffer, alerting without coalescing: {e}")
+            return None
+        if not item:
+            return cls()
+        opened_at = int(item['opened_at']) if item.get('opened_at') is not None else None
+        return cls(opened_at, json.loads(item['entries']), int(item.get('version', 0)))
+
+    def save(self):
+        """
+        Write the buffer if it changed, bumping its version
+
+        An empty buffer is still written rather than deleted, so its version
+        never goes back to a value another invocation may have loaded.
+
+        Returns:
+            False if someone else saved the buffer since it was loaded; reload
+            and reapply the changes before trying again
+        """
+        from botocore.exceptions import ClientError
+        if not self.dirty:
+            return True
+        try:
+            with metrics.span('DynamoDBWrite'):
+                get_table().put_item(
+                    Item={
+                        'ID': ALERT_BUFFER_KEY,
+                        'opened_at': self.opened_at,
+                        'entries': json.dumps(self.entries),
+                        'version': self.version + 1,
+                    },
+                    ConditionExpression='attribute_not_exists(version) OR version = :version',
+                    ExpressionAttributeValues={':version': self.version},
+                )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+        self.version += 1
+        self.dirty = False
+        return True
+
+    def add(self, change_groups, previous, now):
+        """
+        Buffer a sweep's changes
+
+        Args:
+            change_groups: List of (zip_code, area_city, [Availability]) tuples
+            previous: Dict mapping each changed key to its availability before this sweep
+            now: Epoch seconds, opens the window if the buffer was empty
+
+        Returns:
+            Number of keys that flipped back to their baseline and were dropped
+        """
+        collapsed = 0
+        for zip_code, area_city, rows in change_groups:
+            for row in rows:
+                entry = self.entries.get(row.key)
+                baseline = entry['baseline'] if entry else previous.get(row.key)
+                if row.availability == baseline:
+                    self.entries.pop(row.key, None)
+                    collapsed += 1
+                else:
+                    self.entries[row.key] = {'baseline': baseline, 'zip_code': zip_code, 'area_city': area_city, 'row': row.to_dict()}
+                self.dirty = True
+
+        if not self.entries:
+            self.opened_at = None
+        elif self.opened_at is None:
+            self.opened_at = int(now)
+        return collapsed
+
+    def is_due(self, now, window):
+        return self.opened_at is not None and now - self.opened_at >= window
+
+    def has_urgent(self, max_distance):
+        """True if a buffered key became available within `max_distance` miles"""
+        if max_distance is None:
+            return False
+        return any(entry['row']['availability'] == 'available' and entry['baseline'] != 'available'
+                   and entry['row']['distance'] <= max_distance for entry in self.entries.values())
+
+    def drain(self):
+        """
+        Empty the buffer
+
+        Returns:
+            List of (zip_code, area_city, [Availability]) tuples, grouped by
+            ZIP code in the order keys were first buffered
+        """
+        groups = {}
+        for entry in self.entries.values():
+            group = groups.setdefault(entry['zip_code'], (entry['zip_code'], entry['area_city'], []))
+            group[2].append(Availability.from_dict(entry['row']))
+
+        self.dirty = self.dirty or bool(self.entries)
+        self.entries = {}
+        self.opened_at = None
+        return list(groups.values())
+
+
 def escape_markdown(text):
-    """Escape special characters for Telegram Markdown"""
+    """Escape special characters for Telegram Markdown in a single translate() pass"""
     if not text:
         return text
-    # Convert to string if not already
-    text = str(text)
-    # Escape Markdown special characters, but preserve decimal numbers
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '=', '|', '{', '}', '!']
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
+    return str(text).translate(MARKDOWN_ESCAPES)
 
 def sort_available_items(available_items):
     """
@@ -87,19 +1594,56 @@ def sort_available_items(available_items):
     2. Phone size (smaller to larger screen)
     3. Color (alphabetically)
     """
-    def sort_key(item):
-        distance = float(item['distance'])
-        screen_size = float(item['screen_size'])
-        color = item['color']
-        return (distance, screen_size, color)
+    return sorted(available_items, key=attrgetter('sort_key'))
+
+
+def format_change(item):
+    """Render one availability change as a Telegram Markdown block"""
+    availability_icon = '✅' if item.is_available else '🚫'
+    return f"📱 **{escape_markdown(item.model)}**\n🏪 {escape_markdown(item.store)} - {escape_markdown(item.city)} *({escape_markdown(item.zip_code)})*\n📍 [{escape_markdown(item.distance_label)}]({item.maps_link})\n\n{availability_icon} **{item.availability.upper()}**\n\n🛒 [Buy Now]({item.buy_url})"
 
-    return sorted(available_items, key=sort_key)
 
+def format_available_line(item):
+    """Render one row of the currently-available table"""
+    return f"✅ **{escape_markdown(item.model)}** @ {escape_markdown(item.store)} - {escape_markdown(item.city)} *({escape_markdown(item.zip_code)})* - *{escape_markdown(item.distance)} mi* - [Buy Now]({item.buy_url})\n"
 
-def generate_availability_table(available_items):
-    """Generate a compact table of available iPhones with buy links"""
+
+def join_blocks(blocks):
+    """
+    Join (separator, block) pairs into one message. The first block's
+    separator is dropped, as it is at the start of every chunk.
+    """
+    return ''.join([block if i == 0 else separator + block for i, (separator, block) in enumerate(blocks)])
+
+
+def change_blocks(change_groups):
+    """
+    Render the changes section of the consolidated alert as message blocks
+
+    Args:
+        change_groups: List of (zip_code, area_city, [Availability]) tuples
+
+    Returns:
+        List of (separator, block) pairs, one per ZIP header and per change
+    """
+    blocks = []
+    for zip_code, area_city, changes in change_groups:
+        # Add ZIP code header with city and changes
+        blocks.append((CHANGE_SEPARATOR, f"**🚨 STOCK ALERT - {area_city} ({zip_code}) 🚨**"))
+        blocks.extend((CHANGE_SEPARATOR, format_change(item)) for item in changes)
+    return blocks
+
+
+def availability_table_blocks(available_items):
+    """
+    Render the table of available iPhones as message blocks: the heading,
+    then one block per row so long tables can be split between rows
+
+    Returns:
+        List of (separator, block) pairs
+    """
     if not available_items:
-        return "\n**📋 CURRENTLY AVAILABLE**\n\n😔 *No iPhones currently in stock*"
+        return [(TABLE_SEPARATOR, "\n**📋 CURRENTLY AVAILABLE**\n\n😔 *No iPhones currently in stock*")]
 
     # Sort the items before displaying
     sorted_items = sort_available_items(available_items)
@@ -109,285 +1653,1310 @@ def generate_availability_table(available_items):
     items_to_show = sorted_items[:MAX_ITEMS_TO_SHOW]
     remaining_count = len(sorted_items) - MAX_ITEMS_TO_SHOW
 
-    table_text = "\n**📋 CURRENTLY AVAILABLE**\n\n"
-    for item in items_to_show:
-        table_text += f"✅ **{escape_markdown(item['model'])}** @ {escape_markdown(item['store'])} - {escape_markdown(item['city'])} *({escape_markdown(item['zipCode'])})* - *{escape_markdown(item['distance'])} mi* - [Buy Now]({item['buy_url']})\n"
+    blocks = [(TABLE_SEPARATOR, "\n**📋 CURRENTLY AVAILABLE**\n\n")]
+    blocks.extend(('', format_available_line(item)) for item in items_to_show)
 
     # Add note if there are more items
     if remaining_count > 0:
-        table_text += f"\n*\\+{remaining_count} more locations available\\.\\.\\.*"
+        blocks.append(('', f"\n*\\+{remaining_count} more locations available\\.\\.\\.*"))
+
+    return blocks
+
+
+def _split_oversized_block(block, limit):
+    """
+    Cut a block that can't fit in one message: at line breaks where possible,
+    otherwise at the last space before `limit`, never right after an escaping
+    backslash
+    """
+    pieces = []
+    for line in block.split('\n'):
+        while len(line) > limit:
+            cut = line.rfind(' ', 0, limit)
+            if cut <= 0:
+                cut = limit
+            # An odd run of backslashes before the cut means we'd orphan an escape
+            while cut > 1 and (cut - len(line[:cut].rstrip('\\'))) % 2:
+                cut -= 1
+            pieces.append(line[:cut])
+            line = line[cut:]
+        pieces.append(line)
+    return [('\n' if i else '', piece) for i, piece in enumerate(pieces)]
+
+
+def chunk_blocks(blocks, limit):
+    """
+    Pack whole (separator, block) pairs into messages of at most `limit`
+    characters
+
+    A block is only split when it can't fit in a message on its own, so a
+    change entry or a table row never straddles two messages and Markdown
+    entities and escapes stay intact.
+
+    Returns:
+        List of message strings
+    """
+    chunks = []
+    current = []
+    size = 0
+
+    for separator, block in blocks:
+        if len(block) > limit:
+            pieces = _split_oversized_block(block, limit)
+            pieces[0] = (separator, pieces[0][1])
+        else:
+            pieces = [(separator, block)]
 
-    return table_text
+        for separator, piece in pieces:
+            added = len(piece) + (len(separator) if current else 0)
+            if current and size + added > limit:
+                chunks.append(join_blocks(current))
+                current, size = [], 0
+                added = len(piece)
+            current.append((separator, piece))
+            size += added
 
+    if current:
+        chunks.append(join_blocks(current))
+    return chunks
 
-def parse_cookies_to_session(cookie_string, session):
-    """Parse cookie string and add cookies to session"""
+
+def parse_cookies_to_jar(cookie_string, jar):
+    """Parse cookie string and add cookies to a cookie jar"""
     for cookie_pair in cookie_string.split('; '):
         if '=' in cookie_pair:
             name, value = cookie_pair.split('=', 1)
-            session.cookies.set(name, value, domain='.apple.com')
+            jar.set(name, value, domain='.apple.com')
+
 
+def load_cookie_source():
+    """
+    Get the configured cookie string from the environment or .cookies file
 
-def get_apple_cookies():
-    """Get cookies from environment variable or .cookies file"""
-    session = requests.Session()
+    The file is only re-read when its mtime changes, so this is cheap enough
+    to call before every fetch.
+
+    Returns:
+        (cookie_string, source_label), or (None, None) if nothing is configured
+    """
+    global cookie_file_cache
 
     # Priority 1: Get cookies from environment variable
     manual_cookies = os.getenv('APPLE_COOKIES')
     if manual_cookies:
-        print("Using manually configured cookies from environment")
-        parse_cookies_to_session(manual_cookies, session)
-        return session
+        return manual_cookies, "environment"
 
     # Priority 2: Try to read from .cookies file
     try:
-        with open('.cookies', 'r') as f:
-            file_cookies = f.read().strip()
-            if file_cookies:
-                print("Using cookies from .cookies file")
-                parse_cookies_to_session(file_cookies, session)
-                return session
+        mtime = os.stat('.cookies').st_mtime
+        if cookie_file_cache is None or cookie_file_cache[0] != mtime:
+            with open('.cookies', 'r') as f:
+                cookie_file_cache = (mtime, f.read().strip())
+        if cookie_file_cache[1]:
+            return cookie_file_cache[1], ".cookies file"
     except FileNotFoundError:
         pass
     except Exception as e:
         print(f"Error reading .cookies file: {e}")
 
     # Priority 3: No cookies found
-    print("❌ No APPLE_COOKIES environment variable found!")
-    return None
+    return None, None
 
 
-def run(apple_url, bot_token, recipients, zip_code):
-    # bot_token = sys.argv[1]
-    # recipients = json.loads(sys.argv[2])
+class AppleSessionPool:
+    """
+    Long-lived, connection-pooled sessions for the Apple fulfillment API
 
-    # Get cookies first by visiting the Apple store page
-    session = get_apple_cookies()
-    if not session:
-        print("Failed to get Apple cookies, aborting")
+    Every session starts from one master cookie jar. Set-Cookie updates from a
+    response are merged back into the master jar when the session is returned,
+    and the next session handed out picks them up. The jar is persisted to
+    APPLE_COOKIE_JAR_FILE so a later process (or warm invocation) starting from
+    the same configured cookies continues with the refreshed ones.
+    """
 
-        # Send Telegram notification about missing cookies
-        error_message = f"🚨 **iPhone Stock Bot Error**\n\n❌ No Apple cookies configured for ZIP code {zip_code}\n\n💡 Please set the APPLE\\_COOKIES environment variable\n\n⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        telegram_bot_sendtext(error_message, bot_token, recipients)
-        return [], [], False, "Unknown City"
-
-    # Add a small delay to let cookies settle
-    time.sleep(2)
-
-    api_headers = {
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:143.0) Gecko/20100101 Firefox/143.0',
-        'Accept': '*/*',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate, br, zstd',
-        'Referer': 'https://www.apple.com/shop/buy-iphone/iphone-17-pro/6.9-inch-display-512gb-deep-blue-unlocked',
-        'x-skip-redirect': 'true',
-        'Connection': 'keep-alive',
-        'Sec-Fetch-Dest': 'empty',
-        'Sec-Fetch-Mode': 'cors',
-        'Sec-Fetch-Site': 'same-origin',
-        'Priority': 'u=0'
-    }
+    def __init__(self, cookie_string, size, jar_file=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.cookies import RequestsCookieJar
+
+        self.cookie_string = cookie_string
+        self.fingerprint = hashlib.sha256(cookie_string.encode()).hexdigest()
+        self.jar_file = jar_file
+        self.lock = threading.Lock()
+        self.jar = RequestsCookieJar()
+        parse_cookies_to_jar(cookie_string, self.jar)
+        self.persisted = self._load_persisted_jar()
+
+        self.sessions = queue.Queue()
+        for _ in range(size):
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update(APPLE_API_HEADERS)
+            self.sessions.put(session)
+
+    def _load_persisted_jar(self):
+        if not self.jar_file:
+            return None
+        try:
+            with open(self.jar_file, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error reading cookie jar {self.jar_file}: {e}")
+            return None
+
+        # A jar refreshed from different configured cookies is stale
+        if saved.get('fingerprint') != self.fingerprint:
+            return None
+
+        for cookie in saved['cookies']:
+            self.jar.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'],
+                         expires=cookie['expires'], secure=cookie['secure'])
+        print(f"Reusing {len(saved['cookies'])} refreshed cookies from {self.jar_file}")
+        return self._serialize()
+
+    def _serialize(self):
+        cookies = [
+            {'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires, 'secure': c.secure}
+            for c in self.jar
+        ]
+        cookies.sort(key=lambda c: (c['domain'], c['path'], c['name']))
+        return json.dumps({'fingerprint': self.fingerprint, 'cookies': cookies})
+
+    @contextmanager
+    def session(self):
+        """Borrow a session primed with the current master jar"""
+        session = self.sessions.get()
+        try:
+            with self.lock:
+                session.cookies.clear()
+                session.cookies.update(self.jar)
+            yield session
+        finally:
+            with self.lock:
+                self.jar.update(session.cookies)
+            self.sessions.put(session)
+
+    def persist(self):
+        """Write the jar to APPLE_COOKIE_JAR_FILE if it changed since the last write"""
+        if not self.jar_file:
+            return
+        with self.lock:
+            serialized = self._serialize()
+        if serialized == self.persisted:
+            return
+        try:
+            with open(self.jar_file, 'w') as f:
+                f.write(serialized)
+            self.persisted = serialized
+        except Exception as e:
+            print(f"Error writing cookie jar {self.jar_file}: {e}")
+
+
+def get_apple_session_pool():
+    """
+    Return the container-wide Apple session pool, building it on first use or
+    when the configured cookies change
+
+    Returns:
+        AppleSessionPool, or None if no cookies are configured
+    """
+    global apple_session_pool
+
+    with apple_session_pool_lock, metrics.span('CookieLoad'):
+        cookie_string, source = load_cookie_source()
+        if not cookie_string:
+            print("❌ No APPLE_COOKIES environment variable found!")
+            return None
+
+        if apple_session_pool is None or apple_session_pool.cookie_string != cookie_string:
+            print(f"Using cookies from {source}")
+            apple_session_pool = AppleSessionPool(cookie_string, MAX_CONCURRENCY or 4, APPLE_COOKIE_JAR_FILE)
+        return apple_session_pool
 
-    session.headers.update(api_headers)
 
+class _PrefixRecorder:
+    """
+    File-like wrapper that keeps a copy of what was read until stop() is
+    called, so a payload without a stores array can still be fully parsed
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.chunks = []
+        self.recording = True
+
+    def read(self, size=-1):
+        chunk = self.raw.read(size)
+        if self.recording:
+            self.chunks.append(chunk)
+        return chunk
+
+    def stop(self):
+        self.recording = False
+        self.chunks = []
+
+    def recorded(self):
+        return b''.join(self.chunks)
+
+
+def slim_store(store):
+    """Keep only the store fields parse_availability() reads"""
+    slim = {field: store[field] for field in STORE_FIELDS if field in store}
+    slim['address'] = {'postalCode': store['address']['postalCode']}
+    slim['partsAvailability'] = {}
+    for part, details in store['partsAvailability'].items():
+        slim_details = {'pickupDisplay': details['pickupDisplay']}
+        for message_type in ('compact', 'regular'):
+            title = details.get('messageTypes', {}).get(message_type, {}).get('storePickupProductTitle')
+            if title:
+                slim_details.setdefault('messageTypes', {})[message_type] = {'storePickupProductTitle': title}
+        slim['partsAvailability'][part] = slim_details
+    return slim
+
+
+def pickup_stores_array(data):
+    """
+    Find body.content.pickupMessage.stores in a fully parsed response
+
+    Raises:
+        ValueError: If the response doesn't have a stores list there
+    """
+    stores = data
+    for name in ('body', 'content', 'pickupMessage', 'stores'):
+        stores = stores.get(name) if isinstance(stores, dict) else None
+    if not isinstance(stores, list):
+        raise ValueError("unexpected shape: no body.content.pickupMessage.stores list")
+    return stores
+
+
+def iter_pickup_stores(stream):
+    """
+    Incrementally parse a fulfillment response, yielding one slimmed store
+    at a time
+
+    Only the fields parse_availability() reads are kept, so memory stays flat
+    no matter how many stores and parts the payload holds. If the payload has
+    no body.content.pickupMessage.stores array, the bytes read so far are
+    fully parsed instead.
+
+    Args:
+        stream: Binary file-like object positioned at the start of the body
+    """
+    recorder = _PrefixRecorder(stream)
+    item_prefix = STORES_PREFIX + '.item'
+    field_offset = len(item_prefix) + 1
+    in_stores = False
+    store = None
+
+    try:
+        for prefix, event, value in ijson.parse(recorder, use_float=True):
+            if not in_stores:
+                if prefix == STORES_PREFIX and event == 'start_array':
+                    in_stores = True
+                    recorder.stop()
+                continue
+
+            if prefix == STORES_PREFIX and event == 'end_array':
+                return
+            if prefix == item_prefix:
+                if event == 'start_map':
+                    store = {'address': {}, 'partsAvailability': {}}
+                elif event == 'end_map':
+                    yield store
+                    store = None
+                continue
+            if store is None or event in ('start_map', 'end_map', 'start_array', 'end_array', 'map_key'):
+                continue
+
+            field_path = prefix[field_offset:]
+            if field_path in STORE_FIELDS:
+                store[field_path] = value
+            elif field_path == 'address.postalCode':
+                store['address']['postalCode'] = value
+            elif field_path.startswith('partsAvailability.'):
+                part, _, part_field = field_path[len('partsAvailability.'):].partition('.')
+                if part_field == 'pickupDisplay':
+                    store['partsAvailability'].setdefault(part, {})['pickupDisplay'] = value
+                elif part_field in ('messageTypes.compact.storePickupProductTitle', 'messageTypes.regular.storePickupProductTitle'):
+                    message_type = part_field.split('.')[1]
+                    details = store['partsAvailability'].setdefault(part, {})
+                    details.setdefault('messageTypes', {})[message_type] = {'storePickupProductTitle': value}
+    except ijson.JSONError as e:
+        raise ValueError(f"Malformed fulfillment response: {e}") from e
+
+    # Unexpected shape: fall back to a full parse of what we buffered
+    print("Fulfillment response has no pickupMessage.stores array, falling back to full JSON parse")
+    data = json.loads(recorder.recorded())
+    for store in pickup_stores_array(data):
+        yield slim_store(store)
+
+
+def spool_response(raw):
+    """
+    Copy a response body into a spooled temp file, hashing it on the way
+
+    Bodies up to RESPONSE_SPOOL_MEMORY stay in memory and larger ones go to
+    disk, so an unchanged response can be recognised by digest without ever
+    holding the whole body or parsing it.
+
+    Args:
+        raw: Binary file-like object, e.g. a streamed response's `raw`
+
+    Returns:
+        (spool, digest) - the spool is rewound, and the caller closes it
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    spool = tempfile.SpooledTemporaryFile(max_size=RESPONSE_SPOOL_MEMORY)
+    for chunk in iter(lambda: raw.read(RESPONSE_READ_CHUNK), b''):
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def parse_pickup_stores(stream):
+    """
+    Parse the stores out of a successful fulfillment response body
+
+    The body is streamed through iter_pickup_stores() when ijson is
+    installed, so the full JSON tree is never built, and otherwise decoded in
+    one go.
+
+    Args:
+        stream: Binary file-like object positioned at the start of the body
+
+    Returns:
+        List of slimmed store dicts
+    """
+    if ijson is None:
+        data = json.load(stream)
+        return [slim_store(store) for store in pickup_stores_array(data)]
+
+    return list(iter_pickup_stores(stream))
+
+
+class ResponseCache:
+    """
+    Last fulfillment response per request URL, for skipping unchanged ones
+
+    Keeps the validators Apple sent (ETag / Last-Modified), a digest of the
+    body and what a sweep still needs from an unchanged response: the rows
+    that were available and each store's distance. Entries are
+    staged while a sweep runs and only committed once its state rows have
+    been flushed, so a sweep that fails part way never marks a response as
+    already processed.
+
+    The digest only says what this container last saw. Another container may
+    have written different rows for the same URL since then, so an entry is
+    trusted for `ttl` seconds (the availability cache's TTL), after which the
+    response is diffed against the state again.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.staged = {}
+
+    def _fresh_entry(self, url):
+        entry = self.entries.get(url)
+        if entry is None or time.monotonic() - entry['committed_at'] > self.ttl:
+            return None
+        return entry
+
+    def conditional_headers(self, url):
+        with self.lock:
+            entry = self._fresh_entry(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def is_unchanged(self, url, digest):
+        with self.lock:
+            entry = self._fresh_entry(url)
+            return entry is not None and entry['digest'] == digest
+
+    def summary(self, url):
+        """
+        Returns (available_rows, distances, area_city) from the committed
+        response for `url`, which is_unchanged() or a 304 vouched for this sweep
+        """
+        with self.lock:
+            entry = self.entries[url]
+            self.entries.move_to_end(url)
+            return entry['available'], entry['distances'], entry['area_city']
+
+    def stage(self, url, **fields):
+        with self.lock:
+            self.staged.setdefault(url, {}).update(fields)
+
+    def reset_staged(self):
+        with self.lock:
+            self.staged = {}
+
+    def commit(self):
+        with self.lock:
+            committed_at = time.monotonic()
+            for url, entry in self.staged.items():
+                # Fetched but never turned into rows (e.g. the sweep stopped early)
+                if 'available' not in entry or 'digest' not in entry:
+                    continue
+                self.entries[url] = {**entry, 'committed_at': committed_at}
+                self.entries.move_to_end(url)
+            self.staged = {}
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE if RESPONSE_CACHE_SIZE is not None else 256, STATE_CACHE_TTL or 300)
+
+
+class SweepErrors:
+    """
+    Thread-safe collector of per-ZIP fetch failures
+
+    Fetch workers record failures here instead of each sending a Telegram
+    message. The handler then sends a single summary for the whole sweep.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_reason = {}
+
+    def add(self, zip_code, reason):
+        with self.lock:
+            self.by_reason.setdefault(reason, []).append(zip_code)
+
+    def __bool__(self):
+        return bool(self.by_reason)
+
+    def render(self, total_zip_codes):
+        """Render the aggregated Telegram error notification"""
+        failed = sorted({zip_code for zip_codes in self.by_reason.values() for zip_code in zip_codes})
+        lines = [
+            "🚨 **iPhone Stock Bot Error**",
+            "",
+            f"❌ Apple API failed for {len(failed)} of {total_zip_codes} ZIP code(s)",
+            "",
+        ]
+        for reason, zip_codes in sorted(self.by_reason.items()):
+            reason = reason.replace('_', '\\_')
+            lines.append(f"• {reason}: {', '.join(sorted(set(zip_codes)))}")
+        lines += [
+            "",
+            f"⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            "",
+            "💡 This might be due to:\n• Rate limiting\n• Expired cookies\n• API changes",
+        ]
+        return "\n".join(lines)
+
+
+def fetch_apple_data(apple_url, zip_code, errors, use_response_cache=True):
+    """
+    Fetch the fulfillment stores for one ZIP code
+
+    Safe to call from worker threads: it borrows a session from the shared
+    pool and goes through the shared host rate limiter, retry scheduler and
+    circuit breaker. Failures are recorded on `errors` (a SweepErrors) rather
+    than sent right away.
+
+    Sends the validators of the last processed response for this URL and
+    compares a digest of the body with it, so an unchanged response is never
+    parsed. With `use_response_cache` off the response is always parsed.
+
+    Returns:
+        List of slimmed store dicts (see parse_pickup_stores),
+        RESPONSE_UNCHANGED if the response matches the last processed one
+        (rows are in response_cache), or None if the fetch failed
+    """
+    pool = get_apple_session_pool()
+    if not pool:
+        print("Failed to get Apple cookies, aborting")
+        errors.add(zip_code, "No Apple cookies configured, please set the APPLE_COOKIES environment variable")
+        return None
+
+    import requests
+    from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+    host = urlparse(apple_url).netloc
     max_retries = MAX_RETRIES or 3
-    retry_delay = INITIAL_RETRY_DELAY or 1
+    response = None
+
+    with pool.session() as session:
+        for attempt in range(max_retries):
+            if not apple_circuit_breaker.allow(host):
+                print(f"Skipping ZIP code {zip_code}: circuit open for {host}")
+                metrics.incr('AppleCircuitOpenSkips')
+                if attempt == 0:
+                    errors.add(zip_code, "Skipped, Apple is rate limiting (circuit open)")
+                else:
+                    # This ZIP really failed before the circuit opened; report what Apple returned
+                    errors.add(zip_code, f"Status {response.status_code}" if response is not None else "Network error")
+                return None
+
+            try:
+                host_rate_limiter.wait(host)
+                # Headers only: the body is streamed, and timed, by AppleRead
+                with metrics.span('AppleFetch'):
+                    headers = response_cache.conditional_headers(apple_url) if use_response_cache else {}
+                    response = session.get(apple_url, headers=headers,
+                                           timeout=REQUEST_TIMEOUT or 60, allow_redirects=True, stream=True)
+            except requests.RequestException as e:
+                response = None
+                failure = f"error {e}"
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    apple_circuit_breaker.record_success(host)
+                    break
+                response.close()
+                failure = f"status {response.status_code}"
+
+            apple_circuit_breaker.record_failure(host)
+            if attempt < max_retries - 1:
+                delay = apple_retry_scheduler.delay(attempt, response)
+                metrics.incr('AppleRetries')
+                print(f"Attempt {attempt + 1} for ZIP code {zip_code} failed with {failure}. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+        else:
+            print(f"Failed to fetch data for ZIP code {zip_code} after {max_retries} attempts. Last failure: {failure}")
+            errors.add(zip_code, f"Status {response.status_code}" if response is not None else "Network error")
+            return None
+
+        with response:
+            if response.status_code == 304:
+                metrics.incr('AppleResponsesNotModified')
+                return RESPONSE_UNCHANGED
+
+            if response.status_code == 200:
+                spool = None
+                try:
+                    response.raw.decode_content = True
+                    with metrics.span('AppleRead'):
+                        spool, digest = spool_response(response.raw)
+                    if use_response_cache and response_cache.is_unchanged(apple_url, digest):
+                        metrics.incr('AppleResponsesUnchanged')
+                        return RESPONSE_UNCHANGED
+
+                    with metrics.span('AppleParse'):
+                        stores = parse_pickup_stores(spool)
+                    if use_response_cache:
+                        response_cache.stage(apple_url, digest=digest, etag=response.headers.get('ETag'),
+                                             last_modified=response.headers.get('Last-Modified'))
+                    metrics.incr('AppleResponsesChanged')
+                    return stores
+                except (requests.RequestException, Urllib3HTTPError, ValueError) as e:
+                    print(f"Failed to read the fulfillment response for ZIP code {zip_code}: {e}")
+                    errors.add(zip_code, "Unreadable response")
+                    return None
+                except (KeyError, TypeError) as e:
+                    print(f"Unexpected fulfillment response shape for ZIP code {zip_code}: {e!r}")
+                    errors.add(zip_code, "Unexpected response shape")
+                    return None
+                finally:
+                    if spool is not None:
+                        spool.close()
+                    metrics.incr('AppleBytes', response.raw.tell())
+
+    print(f"Failed to fetch the data. Status code: {response.status_code}")
+    errors.add(zip_code, f"Status {response.status_code}")
+    return None
 
-    for attempt in range(max_retries):
-        try:
-            response = session.get(apple_url, timeout=REQUEST_TIMEOUT or 60, allow_redirects=True)
-            if response.status_code not in [503, 541]:
-                break
-        except requests.RequestException as e:
-            if attempt == max_retries - 1:
-                print(f"Failed to fetch data after {max_retries} attempts. Last error: {e}")
-                return [], [], False, "Unknown City"
-
-        if attempt < max_retries - 1:
-            print(f"Attempt {attempt + 1} failed with status {response.status_code if 'response' in locals() else 'unknown'}. Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-            retry_delay *= 2
-
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Load the JSON data from the response
-        data = response.json()
-
-        # Collect availability changes and current available items
-        availability_changes = []
-        currently_available = []
-        area_city = None
-
-        # Iterate over each store in the JSON data
-        for store in data['body']['content']['pickupMessage']['stores']:
-            store_name = store['storeName']
-            store_latitude = store['storelatitude']
-            store_longitude = store['storelongitude']
-            zipCode = store['address']['postalCode']
-            city = store.get('city', 'Unknown City')
-            storeDistanceWithUnit = store['storeDistanceWithUnit']
-            distance_miles = store['storedistance']
-            google_maps_link = f"{GOOGLE_MAPS_BASE_URL}{store_latitude},{store_longitude}"
-
-            # Store the area city (assuming all stores in same ZIP have same city)
-            if area_city is None:
-                area_city = city
 
+def parse_availability(stores):
+    """
+    Flatten fulfillment stores into one Availability record per part per
+    store
+
+    Returns:
+        (rows, area_city)
+    """
+    rows = []
+    area_city = None
+    index = get_part_index()
+
+    # Iterate over each store in the response
+    for store in stores:
+        store_name = store['storeName']
+        store_latitude = store['storelatitude']
+        store_longitude = store['storelongitude']
+        zipCode = store['address']['postalCode']
+        city = store.get('city', 'Unknown City')
+        storeDistanceWithUnit = store['storeDistanceWithUnit']
+        distance_miles = float(store['storedistance'])
+        google_maps_link = f"{GOOGLE_MAPS_BASE_URL}{store_latitude},{store_longitude}"
+
+        # Store the area city (assuming all stores in same ZIP have same city)
+        if area_city is None:
+            area_city = city
+
+        if VERBOSE:
             print(f"-------------------------------------")
             print(f"> {store_name} ({zipCode})")
             print(f"")
 
-            for part, details in store['partsAvailability'].items():
-                availability = details['pickupDisplay']
-
-                # Try to get model name from different possible locations
-                model = None
-                if 'messageTypes' in details:
-                    if 'compact' in details['messageTypes']:
-                        model = details['messageTypes']['compact']['storePickupProductTitle']
-                    elif 'regular' in details['messageTypes']:
-                        model = details['messageTypes']['regular']['storePickupProductTitle']
-
-                if not model:
-                    model = f"iPhone Model {part}"  # Fallback name
-
-                model_parts = model.split(' ')
-                storage = model_parts[4].lower()  # Extracting "1TB"
-                color = '-'.join(model_parts[5:]).lower()  # Converting "Natural Titanium" to "natural-titanium"
-
-                # Extract screen size from model name (e.g., "iPhone 17 Pro Max" -> "6.9" for Pro Max)
-                screen_size = "6.3"  # Default for regular Pro
-                if "Pro Max" in model:
-                    screen_size = "6.9"
-                elif "Pro" in model:
-                    screen_size = "6.3"
-
-                buy_url = f"{APPLE_BUY_BASE_URL}6.9-inch-display-{storage}-{color}-unlocked"
-
-                availability_icon = '🚫'
-                if availability == 'available':
-                    availability_icon = '✅'
-                    currently_available.append({
-                        'model': model,
-                        'store': store_name,
-                        'zipCode': zipCode,
-                        'city': city,
-                        'distance': distance_miles,
-                        'screen_size': float(screen_size),
-                        'color': color,
-                        'storage': storage,
-                        'maps_link': google_maps_link,
-                        'buy_url': buy_url
-                    })
+        for part, details in store['partsAvailability'].items():
+            availability = details['pickupDisplay']
+
+            metadata = index.lookup(part, details)
+            model = metadata.model
+            buy_url = f"{APPLE_BUY_BASE_URL}{metadata.buy_slug}"
 
+            if VERBOSE:
+                availability_icon = '✅' if availability == 'available' else '🚫'
                 print(f"{availability_icon} {model} @ {city} ({zipCode}) is {availability}")
 
-                model_store_key = f"{model}@{store_name}"
+            rows.append(Availability(
+                key=f"{model}@{store_name}",
+                availability=availability,
+                model=model,
+                store=store_name,
+                zip_code=zipCode,
+                city=city,
+                distance=distance_miles,
+                distance_label=storeDistanceWithUnit,
+                screen_size=metadata.screen_size,
+                color=metadata.color,
+                storage=metadata.storage,
+                maps_link=google_maps_link,
+                buy_url=buy_url,
+                part=part
+            ))
+
+    return rows, area_city
+
+
+def diff_availability(rows, area_city, zip_code, state):
+    """
+    Compare parsed rows against the sweep state and collect what changed
 
-                response = table.get_item(Key={'ID': model_store_key})
-                db_item = response.get('Item')
-                if db_item:
-                    db_availability = db_item.get('availability')
-                else:
-                    db_availability = None
-
-                if db_availability != availability:
-                    print(f"Availability changed for {model} @ {zipCode}! Recording change...")
-                    table.put_item(
-                        Item={
-                            'ID': model_store_key,
-                            'availability': availability,
-                            'city': city,
-                            'distance': Decimal(str(distance_miles)),
-                            'screen_size': Decimal(str(screen_size)),
-                            'color': color,
-                            'storage': storage
-                        }
-                    )
-
-                    change_message = f"📱 **{escape_markdown(model)}**\n🏪 {escape_markdown(store_name)} - {escape_markdown(city)} *({escape_markdown(zipCode)})*\n📍 [{escape_markdown(storeDistanceWithUnit)}]({google_maps_link})\n\n{availability_icon} **{availability.upper()}**\n\n🛒 [Buy Now]({buy_url})"
-                    availability_changes.append(change_message)
-
-        # Don't send individual messages - collect changes for consolidation
-        had_changes = bool(availability_changes)
-        if availability_changes:
-            print(f"Availability changes detected for ZIP {zip_code}")
-        else:
-            print("No availability changes detected.")
+    Changed rows are queued on `state`; nothing is written until state.flush().
+    Changes are returned as Availability records; render them with
+    change_blocks() when sending.
 
-        # Return currently available items, changes, change status, and area city for consolidation
-        return currently_available, availability_changes, had_changes, area_city
+    Returns:
+        (currently_available, availability_changes, had_changes, area_city)
+    """
+    # Collect availability changes and current available items
+    availability_changes = []
+    currently_available = []
+
+    for row in rows:
+        if row.is_available:
+            currently_available.append(row)
+
+        if state.record(row.key, row.availability, row):
+            if VERBOSE:
+                print(f"Availability changed for {row.model} @ {row.zip_code}! Recording change...")
+            availability_changes.append(row)
+
+    # Don't send individual messages - collect changes for consolidation
+    had_changes = bool(availability_changes)
+    if availability_changes:
+        print(f"Availability changes detected for ZIP {zip_code}")
     else:
-        print(f"Failed to fetch the data. Status code: {response.status_code}")
+        print("No availability changes detected.")
+
+    # Return currently available items, changes, change status, and area city for consolidation
+    return currently_available, availability_changes, had_changes, area_city
+
+
+def get_telegram_session():
+    """Return the shared keep-alive session used for every Telegram call"""
+    global telegram_session
+    if telegram_session is None:
+        with telegram_session_lock:
+            if telegram_session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                pool_size = TELEGRAM_MAX_CONCURRENCY or 8
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                telegram_session = session
+    return telegram_session
+
+
+def telegram_send_message(bot_token, chat_id, text):
+    """
+    POST one message to one chat, waiting out Telegram's rate limits
+
+    A 429 response carries `parameters.retry_after`; we sleep that long and
+    retry up to TELEGRAM_MAX_ATTEMPTS times.
+    """
+    import requests
+
+    url = f"{TELEGRAM_API_BASE_URL}{bot_token}/sendMessage"
+    payload = {
+        'chat_id': chat_id,
+        'text': text,
+        'parse_mode': 'Markdown',
+        'disable_web_page_preview': True,
+    }
+
+    result = None
+    for attempt in range(TELEGRAM_MAX_ATTEMPTS):
+        telegram_global_limiter.wait('global')
+        telegram_chat_limiter.wait(chat_id)
+        try:
+            with metrics.span('TelegramSend'):
+                response = get_telegram_session().post(url, json=payload, timeout=REQUEST_TIMEOUT or 60)
+                result = response.json()
+            metrics.incr('TelegramBytes', len(response.request.body or b''))
+        except (requests.RequestException, ValueError) as e:
+            print(f"Telegram send to {chat_id} failed: {e}")
+            return None
 
-        # Send Telegram notification about the HTTP error
-        error_message = f"🚨 **iPhone Stock Bot Error**\n\n❌ Apple API returned error for ZIP code {zip_code}\n\n🔢 Status Code: {response.status_code}\n🌐 URL: {apple_url}\n\n⏰ Time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n💡 This might be due to:\n• Rate limiting\n• Expired cookies\n• API changes"
-        telegram_bot_sendtext(error_message, bot_token, recipients)
-        return [], [], False, "Unknown City"
+        if response.status_code != 429:
+            break
+
+        retry_after = result.get('parameters', {}).get('retry_after', 1)
+        print(f"Telegram rate limited chat {chat_id}, retrying in {retry_after} seconds...")
+        metrics.incr('TelegramRetries')
+        time.sleep(retry_after)
+
+    if VERBOSE:
+        print(result)
+    return result
 
 
 def telegram_bot_sendtext(bot_message, bot_token, recipients):
-    MAX_MESSAGE_LENGTH = 4000  # Leave some buffer below the 4096 limit
-
-    # If message is short enough, send as normal
-    if len(bot_message) <= MAX_MESSAGE_LENGTH:
-        for bot_chatID in recipients:
-            send_text = TELEGRAM_API_BASE_URL + bot_token + '/sendMessage?chat_id=' + bot_chatID + '&parse_mode=Markdown&disable_web_page_preview=true&text=' + bot_message
-            response = requests.get(send_text)
-            print(response.json())
+    """
+    Send a message to every recipient, split into Telegram-sized chunks
+
+    Args:
+        bot_message: Message text, or a list of (separator, block) pairs
+            (see change_blocks()) so it can be split between whole blocks
+    """
+    blocks = [('', bot_message)] if isinstance(bot_message, str) else bot_message
+    chunks = chunk_blocks(blocks, TELEGRAM_MESSAGE_LIMIT - CHUNK_HEADER_RESERVE)
+
+    # Add chunk indicator for multi-part messages
+    if len(chunks) > 1:
+        chunks = [f"**📱 iPhone Stock Alert ({i+1}/{len(chunks)})**\n\n{chunk}" for i, chunk in enumerate(chunks)]
+
+    def send_to_chat(bot_chatID):
+        # Chunks for one chat go out in order; chats are sent in parallel
+        for chunk in chunks:
+            telegram_send_message(bot_token, bot_chatID, chunk)
+
+    if not recipients:
         return
 
-    # Split long message into chunks
-    chunks = []
-    current_chunk = ""
-    lines = bot_message.split('\n')
-
-    for line in lines:
-        # If adding this line would exceed the limit, start a new chunk
-        if len(current_chunk) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-            if current_chunk:
-                chunks.append(current_chunk)
-                current_chunk = line
-            else:
-                # Single line too long, truncate it
-                chunks.append(line[:MAX_MESSAGE_LENGTH])
+    max_workers = max(1, min(TELEGRAM_MAX_CONCURRENCY or 8, len(recipients)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(send_to_chat, recipients))
+
+
+def configured_zip_codes():
+    return [zip_code.strip() for zip_code in ZIP_CODES.split(',') if zip_code.strip()] if ZIP_CODES else []
+
+
+def sweep_jobs(zip_codes):
+    """Every (zip_code, models_csv) request of a sweep, ZIP by ZIP"""
+    return [(zip_code, models_csv) for zip_code in zip_codes for models_csv in split_part_batches()]
+
+
+def run_jobs(jobs, errors, planner, fresh=False):
+    """
+    Fetch, parse and diff (zip_code, models_csv) jobs
+
+    Fetches run concurrently; the parsed rows are merged per ZIP, taught to
+    `planner` and diffed in job order against one batch-loaded
+    AvailabilityState. Nothing is written until the caller flushes the
+    returned state.
+
+    Args:
+        fresh: Parse every response and diff against consistent DynamoDB
+            reads, bypassing this container's availability and response
+            caches. Shard workers use it: the rows they diff may have been
+            written by a worker in another container since this one last
+            saw them.
+
+    Returns:
+        (state, change_groups, currently_available)
+    """
+    # Fetch every ZIP x part batch concurrently; Apple's response time dominates a sweep
+    urls = []
+    for zip_code, models_csv in jobs:
+        # Construct Apple URL for this specific ZIP code
+        apple_url = construct_apple_url(location=zip_code, models_csv=models_csv)
+        if VERBOSE:
+            print(f"Constructed Apple URL for {zip_code}: {apple_url}")
+        urls.append((zip_code, apple_url))
+
+    def fetch_job(job):
+        zip_code, apple_url = job
+        print(f"\n--- Checking availability for ZIP code: {zip_code} ---")
+        return fetch_apple_data(apple_url=apple_url, zip_code=zip_code, errors=errors, use_response_cache=not fresh)
+
+    if not fresh:
+        response_cache.reset_staged()
+    max_workers = max(1, min(MAX_CONCURRENCY or 4, len(urls)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # map() yields in submission order, so merging below stays deterministic
+        fetched = list(executor.map(fetch_job, urls))
+
+    # Parse everything first so the whole sweep's state is read in one batch.
+    # Unchanged responses were diffed when they were first seen, so only their
+    # store distances and available rows are reused, for coverage and the
+    # currently-available table.
+    parsed = {}
+    unchanged_count = 0
+    for (zip_code, apple_url), stores in zip(urls, fetched):
+        if stores is None:
+            continue
+        if stores is RESPONSE_UNCHANGED:
+            unchanged_count += 1
+            unchanged_available, distances, area_city = response_cache.summary(apple_url)
+            changed_rows = []
         else:
-            if current_chunk:
-                current_chunk += '\n' + line
-            else:
-                current_chunk = line
+            print(f"\n--- Parsing availability for ZIP code: {zip_code} ---")
+            try:
+                with metrics.span('Parse'):
+                    rows, area_city = parse_availability(stores)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Unexpected fulfillment store shape for ZIP code {zip_code}: {e!r}")
+                errors.add(zip_code, "Unexpected response shape")
+                continue
+            distances = {row.store: row.distance for row in rows}
+            if not fresh:
+                response_cache.stage(apple_url, available=[row for row in rows if row.is_available],
+                                     distances=distances, area_city=area_city)
+            changed_rows, unchanged_available = rows, []
+        zip_changed, zip_unchanged, zip_distances, zip_city = parsed.get(zip_code, ([], [], {}, None))
+        parsed[zip_code] = (zip_changed + changed_rows, zip_unchanged + unchanged_available,
+                            {**zip_distances, **distances}, zip_city or area_city)
+
+    fetched_count = sum(1 for stores in fetched if stores is not None)
+    if unchanged_count:
+        print(f"Skipped parsing and diffing {unchanged_count} of {fetched_count} unchanged responses")
+
+    for zip_code, (_, _, distances, _) in parsed.items():
+        planner.learn(zip_code, distances)
+
+    state = AvailabilityState(use_cache=not fresh)
+    state.load([row.key for changed_rows, _, _, _ in parsed.values() for row in changed_rows])
+
+    # Diff sequentially in configured ZIP order
+    change_groups = []
+    currently_available = []
+    for zip_code, (changed_rows, unchanged_available, _, area_city) in parsed.items():
+        if changed_rows:
+            available, availability_changes, had_changes, area_city = diff_availability(changed_rows, area_city, zip_code, state)
+
+            if had_changes:
+                change_groups.append((zip_code, area_city, availability_changes))
+                metrics.incr('AvailabilityChanges', len(availability_changes))
+
+            currently_available.extend(available)
+        currently_available.extend(unchanged_available)
+
+    return state, change_groups, currently_available
+
+
+def notify_errors(errors, zip_count, bot_token, recipients):
+    """One error notification per sweep, however many ZIPs failed"""
+    if not errors:
+        return
+    print(f"Fetch failures this sweep: {errors.by_reason}")
+    if bot_token and recipients:
+        telegram_bot_sendtext(errors.render(zip_count), bot_token, recipients)
 
-    # Add the last chunk
-    if current_chunk:
-        chunks.append(current_chunk)
 
-    # Send each chunk
-    for i, chunk in enumerate(chunks):
-        # Add chunk indicator for multi-part messages
-        if len(chunks) > 1:
-            chunk_header = f"**📱 iPhone Stock Alert ({i+1}/{len(chunks)})**\n\n"
-            chunk = chunk_header + chunk
+def coalesce_changes(change_groups, previous):
+    """
+    Decide which changes to alert on now when ALERT_COALESCE_WINDOW is set
+
+    This sweep's changes join the buffer. The whole buffer is released as one
+    alert once its window has elapsed, or straight away if it holds stock that
+    just became available within URGENT_ALERT_DISTANCE miles.
+
+    The buffer is saved before anything is sent, so two overlapping
+    invocations can't both release it. If another invocation saved it first,
+    we reload and reapply this sweep's changes, up to ALERT_BUFFER_ATTEMPTS
+    times, and then give up and send them directly.
+
+    Args:
+        change_groups: This sweep's (zip_code, area_city, [Availability]) tuples
+        previous: Dict mapping each changed key to its availability before this sweep
+
+    Returns:
+        List of (zip_code, area_city, [Availability]) tuples to send now
+    """
+    if not ALERT_COALESCE_WINDOW:
+        return change_groups
+
+    for attempt in range(ALERT_BUFFER_ATTEMPTS):
+        buffer = AlertBuffer.load()
+        if buffer is None:
+            return change_groups
+
+        now = time.time()
+        collapsed = buffer.add(change_groups, previous, now)
+        buffered = len(buffer.entries)
+        urgent = buffer.has_urgent(URGENT_ALERT_DISTANCE)
+        due = buffer.is_due(now, ALERT_COALESCE_WINDOW)
+        opened_at = buffer.opened_at
+        released = buffer.drain() if urgent or due else []
+
+        try:
+            if buffer.save():
+                break
+        except Exception as e:
+            print(f"Could not save the alert buffer, alerting without coalescing: {e}")
+            return change_groups
+        print(f"Alert buffer changed since it was loaded, retrying ({attempt + 1}/{ALERT_BUFFER_ATTEMPTS})")
+        metrics.incr('AlertBufferConflicts')
+    else:
+        print("Alert buffer kept changing, alerting without coalescing")
+        return change_groups
+
+    if collapsed:
+        print(f"Dropped {collapsed} changes that flipped back within the alert window")
+        metrics.incr('AlertFlapsCollapsed', collapsed)
+
+    if urgent:
+        print(f"Newly available stock within {URGENT_ALERT_DISTANCE} mi, sending {buffered} buffered changes now")
+        metrics.incr('AlertsUrgent')
+    elif due:
+        print(f"Alert window elapsed, sending {buffered} buffered changes")
+    elif buffered:
+        print(f"Holding {buffered} changes for {opened_at + ALERT_COALESCE_WINDOW - now:.0f}s more")
+        metrics.incr('AlertChangesHeld', buffered)
+    return released
+
+
+def send_alert(bot_token, subscriptions, coverage, change_groups, currently_available):
+    """Send the consolidated alert for a sweep, one rendered message per distinct subscriber view"""
+    recipients = [subscription.chat_id for subscription in subscriptions]
+    if not (bot_token and recipients and change_groups):
+        print("No message sent (no changes detected)")
+        return
 
-        for bot_chatID in recipients:
-            send_text = TELEGRAM_API_BASE_URL + bot_token + '/sendMessage?chat_id=' + bot_chatID + '&parse_mode=Markdown&disable_web_page_preview=true&text=' + chunk
-            response = requests.get(send_text)
-            print(response.json())
+    # Remove duplicates from available items
+    unique_available = []
+    seen_items = set()
+    for item in currently_available:
+        item_key = (item.model, item.store, item.city, item.zip_code)
+        if item_key not in seen_items:
+            seen_items.add(item_key)
+            unique_available.append(item)
+
+    # Route every row once, then render each distinct filtered view once
+    router = SubscriptionRouter(subscriptions, coverage)
+    views = router.views(change_groups, unique_available)
+    metrics.incr('AlertViews', len(views))
+
+    for chat_ids, view_changes, view_available in views:
+        # Build consolidated message as blocks so chunking never splits an entry
+        with metrics.span('Render'):
+            message_blocks = change_blocks(view_changes) + availability_table_blocks(view_available)
+
+        print(f"\nSending consolidated message with {len(view_available)} unique available items to {chat_ids}:")
+        print(join_blocks(message_blocks))
+        telegram_bot_sendtext(message_blocks, bot_token, chat_ids)
+
+
+def sweep_key(sweep_id, shard=None):
+    key = f"{SWEEP_KEY_PREFIX}{sweep_id}"
+    return key if shard is None else f"{key}#shard#{shard}"
+
+
+def split_shards(jobs, shard_count):
+    """Split jobs into at most `shard_count` contiguous, near-equal slices"""
+    shard_count = max(1, min(shard_count, len(jobs)))
+    size, extra = divmod(len(jobs), shard_count)
+    shards = []
+    start = 0
+    for i in range(shard_count):
+        end = start + size + (1 if i < extra else 0)
+        shards.append(jobs[start:end])
+        start = end
+    return shards
+
+
+def invoke_shards(payloads):
+    """Dispatch shard payloads as asynchronous invocations of this (or SHARD_FUNCTION_NAME's) Lambda"""
+    import boto3
+
+    function_name = SHARD_FUNCTION_NAME or os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+    client = boto3.client('lambda')
+    for payload in payloads:
+        client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload).encode('utf-8'))
+    print(f"Invoked {len(payloads)} shard workers of {function_name}")
+
+
+def claim_sweep(sweep_id):
+    """Mark a sweep finished with a conditional write; returns False if someone else already did"""
+    from botocore.exceptions import ClientError
+    try:
+        with metrics.span('DynamoDBWrite'):
+            get_table().update_item(
+                Key={'ID': sweep_key(sweep_id)},
+                UpdateExpression='SET finished_at = :now',
+                ConditionExpression='attribute_exists(shard_count) AND attribute_not_exists(finished_at)',
+                ExpressionAttributeValues={':now': int(time.time())},
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return False
+    return True
+
+
+def finish_stale_sweeps(bot_token, deadline):
+    """
+    Finish open sweeps that started more than `deadline` seconds ago
 
-            # Small delay between chunks to avoid rate limiting
-            if i < len(chunks) - 1:
-                time.sleep(0.5)
+    A worker that times out or runs out of async retries never marks its
+    shard done, so its sweep would never alert. The other shards have already
+    flushed their state rows and would never be detected again, so their
+    saved results are merged and alerted here; the missing shards' rows were
+    never written and are picked up by a later sweep.
+    """
+    with metrics.span('DynamoDBRead'):
+        index = get_table().get_item(Key={'ID': SWEEP_INDEX_KEY}, ConsistentRead=True).get('Item')
+    sweep_ids = sorted(index.get('sweep_ids', ())) if index else []
+    if not sweep_ids:
+        return
+
+    items = batch_get_items([sweep_key(sweep_id) for sweep_id in sweep_ids])
+    now = time.time()
+    for sweep_id in sweep_ids:
+        sweep = items.get(sweep_key(sweep_id))
+        if sweep is None:
+            # Finished (or expired) since the index was read
+            forget_sweep(sweep_id)
+            continue
+        if 'finished_at' in sweep or now - int(sweep.get('started_at', 0)) < deadline:
+            continue
+        if not claim_sweep(sweep_id):
+            continue
+
+        shard_count = int(sweep['shard_count'])
+        done = len(sweep.get('done_shards', ()))
+        print(f"Sweep {sweep_id} passed its {deadline}s deadline with {done}/{shard_count} shards done, finishing it")
+        metrics.incr('SweepsFinishedLate')
+        finish_sweep(sweep_id, shard_count, int(sweep['zip_count']), bot_token)
+
+
+def forget_sweep(sweep_id):
+    with metrics.span('DynamoDBWrite'):
+        get_table().update_item(
+            Key={'ID': SWEEP_INDEX_KEY},
+            UpdateExpression='DELETE sweep_ids :sweep_id',
+            ExpressionAttributeValues={':sweep_id': {sweep_id}},
+        )
+
+
+def coordinate_sweep(shard_count, dispatch=invoke_shards, bot_token=None):
+    """
+    Split this sweep's ZIP x part-batch jobs into shards and hand them to
+    workers
+
+    The sweep item records how many shards there are; workers mark
+    themselves done on it, and whichever completes the set sends the alert
+    (see handle_shard()). Open sweeps are also listed in the sweep index,
+    so sweeps whose workers never finished are completed here once they are
+    SWEEP_DEADLINE seconds old (see finish_stale_sweeps()).
+
+    Args:
+        shard_count: Maximum number of shards
+        dispatch: Called with the list of worker event payloads
+        bot_token: Used to alert on stale sweeps
+
+    Returns:
+        Sweep ID, or None if there was nothing to do
+    """
+    finish_stale_sweeps(bot_token, SWEEP_DEADLINE or 3600)
+
+    zip_codes = configured_zip_codes()
+    planner = FetchPlanner.load() if FETCH_PLANNER_ENABLED else FetchPlanner()
+    planned_zip_codes = planner.plan(zip_codes)
+    jobs = sweep_jobs(planned_zip_codes)
+    if not jobs:
+        print("No ZIP codes configured")
+        return None
+
+    shards = split_shards(jobs, shard_count)
+    sweep_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.urandom(4).hex()}"
+    with metrics.span('DynamoDBWrite'):
+        get_table().put_item(Item={
+            'ID': sweep_key(sweep_id),
+            'shard_count': len(shards),
+            'zip_count': len(planned_zip_codes),
+            'started_at': int(time.time()),
+            'expires_at': int(time.time()) + SWEEP_TTL,
+        })
+        get_table().update_item(
+            Key={'ID': SWEEP_INDEX_KEY},
+            UpdateExpression='ADD sweep_ids :sweep_id',
+            ExpressionAttributeValues={':sweep_id': {sweep_id}},
+        )
+
+    print(f"Sweep {sweep_id}: {len(jobs)} requests for {len(planned_zip_codes)} ZIP codes in {len(shards)} shards")
+    metrics.incr('ZipCodesPlanned', len(planned_zip_codes))
+    metrics.incr('ZipCodesSkipped', len(zip_codes) - len(planned_zip_codes))
+    metrics.incr('ShardsDispatched', len(shards))
+
+    dispatch([
+        {'mode': 'worker', 'sweep_id': sweep_id, 'shard': i, 'jobs': [list(job) for job in shard]}
+        for i, shard in enumerate(shards)
+    ])
+    return sweep_id
+
+
+def handle_shard(event, bot_token):
+    """
+    Process one shard of a sweep and, if it is the last to finish, send the
+    sweep's single consolidated alert
+
+    The shard's result is saved before its state rows are flushed, so an
+    async retry of a worker that died after the flush resends the saved
+    changes instead of losing them. Marking the shard done is a conditional
+    add to a string set, so a retried shard can't be counted twice. Only the
+    worker whose add completes the set merges the shard results, and it
+    claims the sweep with a conditional write before alerting.
+    """
+    sweep_id, shard = event['sweep_id'], int(event['shard'])
+    print(f"Sweep {sweep_id}: running shard {shard} ({len(event['jobs'])} requests)")
+
+    items = batch_get_items([sweep_key(sweep_id), sweep_key(sweep_id, shard)])
+    if sweep_key(sweep_id) not in items:
+        print(f"Sweep {sweep_id} is unknown or already finished, ignoring shard {shard}")
+        return
+
+    if sweep_key(sweep_id, shard) in items:
+        print(f"Shard {shard} already has a saved result, skipping to completion")
+    else:
+        errors = SweepErrors()
+        planner = FetchPlanner()
+        state, change_groups, currently_available = run_jobs([tuple(job) for job in event['jobs']], errors, planner, fresh=True)
+        result = {
+            'changes': [[zip_code, area_city, [row.to_dict() for row in rows]] for zip_code, area_city, rows in change_groups],
+            'available': [row.to_dict() for row in currently_available],
+            'previous': {row.key: state.previous.get(row.key) for _, _, rows in change_groups for row in rows},
+            'errors': errors.by_reason,
+            'coverage': {zip_code: entry['distances'] for zip_code, entry in planner.coverage.items()},
+        }
+        with metrics.span('DynamoDBWrite'):
+            get_table().put_item(Item={
+                'ID': sweep_key(sweep_id, shard),
+                'result': zlib.compress(json.dumps(result).encode('utf-8')),
+                'expires_at': int(time.time()) + SWEEP_TTL,
+            })
+        state.flush()
+
+    from botocore.exceptions import ClientError
+    try:
+        with metrics.span('DynamoDBWrite'):
+            sweep = get_table().update_item(
+                Key={'ID': sweep_key(sweep_id)},
+                UpdateExpression='ADD done_shards :shard',
+                ConditionExpression='attribute_exists(shard_count) AND NOT contains(done_shards, :shard_id)',
+                ExpressionAttributeValues={':shard': {str(shard)}, ':shard_id': str(shard)},
+                ReturnValues='ALL_NEW',
+            )['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Shard {shard} of sweep {sweep_id} was already counted")
+        return
+
+    shard_count = int(sweep['shard_count'])
+    if len(sweep['done_shards']) < shard_count:
+        print(f"Sweep {sweep_id}: {len(sweep['done_shards'])}/{shard_count} shards done")
+        return
+
+    if not claim_sweep(sweep_id):
+        print(f"Sweep {sweep_id} was already finished by another worker")
+        return
+
+    print(f"Sweep {sweep_id}: all {shard_count} shards done, sending the consolidated alert")
+    finish_sweep(sweep_id, shard_count, int(sweep['zip_count']), bot_token)
+
+
+def finish_sweep(sweep_id, shard_count, zip_count, bot_token):
+    """Merge every shard's saved result, update planner coverage and send one alert"""
+    shard_keys = [sweep_key(sweep_id, shard) for shard in range(shard_count)]
+    items = batch_get_items(shard_keys)
+
+    errors = SweepErrors()
+    groups = {}
+    seen_changes = set()
+    previous = {}
+    currently_available = []
+    planner = FetchPlanner.load() if FETCH_PLANNER_ENABLED else FetchPlanner()
+
+    # Shards are contiguous slices of the ZIP order, so merging by shard index keeps it
+    for key in shard_keys:
+        if key not in items:
+            print(f"Missing result for {key}, its changes are left out of the alert")
+            continue
+        result = json.loads(zlib.decompress(bytes(items[key]['result'])))
+
+        for reason, zip_codes in result['errors'].items():
+            for zip_code in zip_codes:
+                errors.add(zip_code, reason)
+        for zip_code, distances in result['coverage'].items():
+            planner.learn(zip_code, distances)
+        for zip_code, area_city, rows in result['changes']:
+            group = groups.setdefault(zip_code, (zip_code, area_city, []))
+            for row in rows:
+                # Overlapping ZIPs in different shards can both see the same store change
+                if row['key'] not in seen_changes:
+                    seen_changes.add(row['key'])
+                    group[2].append(Availability.from_dict(row))
+        currently_available.extend(Availability.from_dict(row) for row in result['available'])
+        for key, availability in result.get('previous', {}).items():
+            previous.setdefault(key, availability)
+
+    if FETCH_PLANNER_ENABLED:
+        planner.save()
+
+    subscriptions = get_subscriptions()
+    recipients = [subscription.chat_id for subscription in subscriptions]
+    notify_errors(errors, zip_count, bot_token, recipients)
+    change_groups = coalesce_changes([group for group in groups.values() if group[2]], previous)
+    send_alert(bot_token, subscriptions, planner.coverage, change_groups, currently_available)
+
+    batch_delete_items(shard_keys + [sweep_key(sweep_id)])
+    forget_sweep(sweep_id)
 
 
 def handler(event, context):
     import datetime
     print(f"\n=== Lambda handler started at {datetime.datetime.now()} ===")
+    handler_start = time.perf_counter()
+    metrics.reset()
+    event = event or {}
+
+    # Warm the availability cache from the change log: snapshot + tail on a cold start, just the tail after
+    log = get_change_log()
+    if log:
+        try:
+            with metrics.span('ChangeLogSync'):
+                metrics.incr('ChangeLogReplayedEvents', log.sync(availability_cache))
+        except Exception as e:
+            print(f"Change log sync failed, falling back to state rows: {e}")
 
     # Get parameters from environment variables
     bot_token = TELEGRAM_BOT_TOKEN
-    recipients = TELEGRAM_CHAT_IDS.split(',') if TELEGRAM_CHAT_IDS else []
+    recipient_subscriptions = get_subscriptions()
+    recipients = [subscription.chat_id for subscription in recipient_subscriptions]
 
     # Process multiple ZIP codes
-    zip_codes = ZIP_CODES.split(',') if ZIP_CODES else []
+    zip_codes = configured_zip_codes()
 
     if bot_token:
         print(f"Bot token received!")
@@ -395,63 +2964,53 @@ def handler(event, context):
     if recipients:
         print(f"Recipients: {recipients}")
 
-    if zip_codes:
-        print(f"ZIP codes to check: {zip_codes}")
-
-        # Collect all changes and currently available items across all ZIP codes
-        all_currently_available = []
-        all_changes = []
-        any_changes_detected = False
+    shard_count = event.get('shard_count', SHARD_COUNT) or 1
+    can_dispatch = SHARD_FUNCTION_NAME or os.getenv('AWS_LAMBDA_FUNCTION_NAME')
 
-        # Check availability for each ZIP code
-        for zip_code in zip_codes:
-            zip_code = zip_code.strip()
-            print(f"\n--- Checking availability for ZIP code: {zip_code} ---")
-
-            # Construct Apple URL for this specific ZIP code
-            apple_url = construct_apple_url(location=zip_code)
-            print(f"Constructed Apple URL: {apple_url}")
-
-            if apple_url:
-                print("Checking iPhone stock availability")
-                currently_available, availability_changes, had_changes, area_city = run(apple_url=apple_url, bot_token=bot_token, recipients=recipients, zip_code=zip_code)
-
-                if had_changes:
-                    any_changes_detected = True
-                    # Add ZIP code header with city and changes
-                    zip_header = f"**🚨 STOCK ALERT - {area_city} ({zip_code}) 🚨**"
-                    all_changes.append(zip_header)
-                    all_changes.extend(availability_changes)
-
-                if currently_available:
-                    all_currently_available.extend(currently_available)
-
-        # Send consolidated message only if there were changes
-        if bot_token and recipients and any_changes_detected:
-            # Remove duplicates from available items
-            unique_available = []
-            seen_items = set()
-
-            for item in all_currently_available:
-                item_key = f"{item['model']}@{item['store']}@{item['city']}@{item['zipCode']}"
-                if item_key not in seen_items:
-                    seen_items.add(item_key)
-                    unique_available.append(item)
-
-            # Build consolidated message
-            changes_section = "\n\n---\n\n".join(all_changes)
-            availability_table = generate_availability_table(unique_available)
-
-            final_message = changes_section
-            if availability_table:
-                final_message += "\n\n---\n" + availability_table
-
-            print(f"\nSending consolidated message with {len(unique_available)} unique available items:")
-            print(final_message)
-            telegram_bot_sendtext(final_message, bot_token, recipients)
-        else:
-            print("No message sent (no changes detected)")
-    else:
+    if event.get('mode') == 'worker':
+        handle_shard(event, bot_token)
+    elif not zip_codes:
         print("No ZIP codes configured")
+    elif shard_count > 1 and can_dispatch:
+        print(f"ZIP codes to check: {zip_codes}")
+        coordinate_sweep(shard_count, bot_token=bot_token)
+    else:
+        if shard_count > 1:
+            print("Sharding needs SHARD_FUNCTION_NAME outside Lambda; running the whole sweep here")
+        print(f"ZIP codes to check: {zip_codes}")
+
+        # Skip ZIPs whose stores are already covered by other ZIPs' responses
+        planner = FetchPlanner.load() if FETCH_PLANNER_ENABLED else FetchPlanner()
+        planned_zip_codes = planner.plan(zip_codes)
+        skipped = [zip_code for zip_code in zip_codes if zip_code not in planned_zip_codes]
+        if skipped:
+            print(f"Fetch planner skipping ZIP codes covered by others: {skipped}")
+        metrics.incr('ZipCodesPlanned', len(planned_zip_codes))
+        metrics.incr('ZipCodesSkipped', len(skipped))
+
+        errors = SweepErrors()
+        state, all_changes, all_currently_available = run_jobs(sweep_jobs(planned_zip_codes), errors, planner)
+        notify_errors(errors, len(planned_zip_codes), bot_token, recipients)
+
+        if FETCH_PLANNER_ENABLED:
+            planner.save()
+        previous = dict(state.previous)
+        state.flush()
+        response_cache.commit()
+
+        # Send consolidated message only if there were changes, or hold them for the alert window
+        all_changes = coalesce_changes(all_changes, previous)
+        send_alert(bot_token, recipient_subscriptions, planner.coverage, all_changes, all_currently_available)
+
+    if apple_session_pool:
+        apple_session_pool.persist()
+
+    print(f"Availability cache: {availability_cache.hits} hits, {availability_cache.misses} misses, {len(availability_cache.entries)} entries")
+    metrics.incr('StateCacheHits', availability_cache.hits)
+    metrics.incr('StateCacheMisses', availability_cache.misses)
+    availability_cache.reset_stats()
+
+    metrics.observe('Handler', time.perf_counter() - handler_start)
+    metrics.emit()
 
     return { 'status' : 200, 'body' : 'Lambda executed successfully!' }
@@ -1,34 +1,46 @@
 #!/usr/bin/env python3
 
+import argparse
+import json
 import os
-import boto3
-from lambda_function import handler
+import subprocess
+import sys
 
-# Configure boto3 to use local DynamoDB
-os.environ['AWS_ENDPOINT_URL'] = 'http://dynamodb:8000'
+# Point lambda_function at the local DynamoDB container before it is imported
+os.environ.setdefault('DYNAMODB_ENDPOINT_URL', 'http://dynamodb:8000')
 
-# Override boto3 to use local endpoint
-def get_local_dynamodb():
-    return boto3.resource('dynamodb',
-                         endpoint_url='http://dynamodb:8000',
-                         region_name='us-east-1',
-                         aws_access_key_id='test',
-                         aws_secret_access_key='test')
+import lambda_function
+from lambda_function import handler
 
-# Patch the lambda_function to use local DynamoDB
+# Run inside a fresh interpreter by --profile-startup; prints init timings as JSON
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
 import lambda_function
-lambda_function.dynamodb = get_local_dynamodb()
-lambda_function.table = lambda_function.dynamodb.Table(os.getenv('DYNAMODB_TABLE_NAME'))
+imported = time.perf_counter()
+lambda_function.get_table()
+dynamodb_ready = time.perf_counter()
+lambda_function.get_telegram_session()
+telegram_ready = time.perf_counter()
+print(json.dumps({
+    'import lambda_function': imported - start,
+    'get_table()': dynamodb_ready - imported,
+    'get_telegram_session()': telegram_ready - dynamodb_ready,
+}))
+"""
 
-# Create the DynamoDB table if it doesn't exist
+
+# Create the DynamoDB table if it doesn't exist; returns True if it was created
 def create_table_if_not_exists():
+    dynamodb = lambda_function.get_dynamodb()
     try:
-        table = lambda_function.table
+        table = lambda_function.get_table()
         table.load()
         print(f"Table {os.getenv('DYNAMODB_TABLE_NAME')} already exists")
-    except table.meta.client.exceptions.ResourceNotFoundException:
+        return False
+    except dynamodb.meta.client.exceptions.ResourceNotFoundException:
         print(f"Creating table {os.getenv('DYNAMODB_TABLE_NAME')}")
-        table = lambda_function.dynamodb.create_table(
+        table = dynamodb.create_table(
             TableName=os.getenv('DYNAMODB_TABLE_NAME'),
             KeySchema=[
                 {
@@ -46,8 +58,51 @@ def create_table_if_not_exists():
         )
         table.wait_until_exists()
         print(f"Table {os.getenv('DYNAMODB_TABLE_NAME')} created successfully")
+        return True
+
+
+def profile_startup(top):
+    """
+    Report where cold-start time goes: `-X importtime` for the module import
+    and wall-clock timings for lazily created clients, both measured in a
+    fresh interpreter
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+    )
+
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Only top-level imports; nested ones are already in their parent's cumulative time
+        if name.startswith(' ') and not name.startswith('  '):
+            imports.append((int(cumulative_us), int(self_us), name.strip()))
+
+    imports.sort(reverse=True)
+    print(f"=== Slowest top-level imports (of {len(imports)}) ===")
+    for cumulative_us, self_us, name in imports[:top]:
+        print(f"{cumulative_us / 1000:9.1f} ms cumulative {self_us / 1000:8.1f} ms self  {name}")
+
+    print("=== Init timings ===")
+    for step, seconds in json.loads(result.stdout.strip().splitlines()[-1]).items():
+        print(f"{seconds * 1000:9.1f} ms  {step}")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Lambda handler against dynamodb-local")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Report import-time and client init-time breakdown instead of running the handler")
+    parser.add_argument('--top', type=int, default=15, help="Number of imports to show with --profile-startup")
+    args = parser.parse_args()
+
+    if args.profile_startup:
+        profile_startup(args.top)
+        sys.exit(0)
+
     create_table_if_not_exists()
 
     # Run the Lambda handler
@@ -55,5 +110,4 @@ if __name__ == "__main__":
     print(f"Handler result: {result}")
 
     # Explicit exit to ensure container terminates
-    import sys
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
@@ -29,18 +29,22 @@ cleanup() {
 # Trap SIGINT (Ctrl+C) and SIGTERM
 trap cleanup SIGINT SIGTERM
 
-# Start DynamoDB once
-echo "=== Starting DynamoDB ==="
-docker-compose up -d dynamodb
+# Grab cookies before the daemon's first cycle
+echo -e "\n=== $(date) - Grabbing fresh cookies ==="
+bash get-cookie.sh
 
-# Main loop
+# Start DynamoDB and the resident bot once; the daemon polls on its own
+# schedule and picks up refreshed .cookies without restarting
+echo "=== Starting DynamoDB and iPhone Stock Bot daemon ==="
+POLL_INTERVAL="$INTERVAL" docker-compose up -d dynamodb iphone-stock-bot-daemon
+docker-compose logs -f iphone-stock-bot-daemon &
+
+# Main loop: keep the cookies fresh
 while true; do
+    echo -e "\n=== $(date) - Waiting $INTERVAL seconds before refreshing cookies ==="
+    sleep "$INTERVAL" &
+    wait $!
+
     echo -e "\n=== $(date) - Grabbing fresh cookies ==="
     bash get-cookie.sh
-
-    echo -e "\n=== $(date) - Running iPhone Stock Bot ==="
-    docker-compose run --rm iphone-stock-bot
-
-    echo -e "\n=== $(date) - Waiting $INTERVAL seconds before next run ==="
-    sleep "$INTERVAL"
 done
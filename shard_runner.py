@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Run one sharded sweep locally
+
+The coordinator plans and splits the sweep exactly as it does in Lambda, but
+each shard runs in a fresh process instead of an async invocation. Shards
+share nothing but DynamoDB, so the completion bookkeeping and the single
+consolidated alert behave as they do in AWS.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+# Point lambda_function at the local DynamoDB container before it is imported
+os.environ.setdefault('DYNAMODB_ENDPOINT_URL', 'http://dynamodb:8000')
+
+import lambda_function
+from local_runner import create_table_if_not_exists
+
+
+def run_shard(payload):
+    lambda_function.handler(payload, {})
+
+
+def dispatch_to_processes(processes):
+    """Return a coordinate_sweep() dispatcher that runs each shard in its own spawned process"""
+    def dispatch(payloads):
+        context = multiprocessing.get_context('spawn')
+        # One shard per process, like a cold worker invocation
+        with context.Pool(processes or len(payloads), maxtasksperchild=1) as pool:
+            pool.map(run_shard, payloads, chunksize=1)
+
+    return dispatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', type=int, default=lambda_function.SHARD_COUNT or 4, help="Number of shards (default: SHARD_COUNT or 4)")
+    parser.add_argument('--processes', type=int, help="Shards run at once (default: all of them)")
+    args = parser.parse_args()
+
+    create_table_if_not_exists()
+
+    sweep_id = lambda_function.coordinate_sweep(args.shards, dispatch=dispatch_to_processes(args.processes),
+                                                bot_token=lambda_function.TELEGRAM_BOT_TOKEN)
+    if sweep_id:
+        print(f"=== Sweep {sweep_id} finished ===")
+
+
+if __name__ == '__main__':
+    sys.exit(main())